@@ -0,0 +1,141 @@
+"""
+Benchmark suite of the pipeline on synthetic surveys (see questions/synthetic.py)
+Times and memory-profiles Kobo.read_form, both parse_form methods (Kobo also in compact form), ChoiceExperiment.design_to_choices
+and encode_dataset across numbers of respondents. Results are stored as json so runs can be compared:
+    python benchmark.py --sizes 100 1000 10000
+    python benchmark.py --compare benchmark_results/old.json benchmark_results/new.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import io
+import numpy as np
+import pandas as pd
+from questions import Questionaire, Kobo, ChoiceExperiment
+from questions.sheets import FakeSheets
+from questions import synthetic
+
+def measure(setup, run, memory: bool = True) -> dict:
+    """
+    Wall time of run(state) on a fresh state = setup(), and in a second pass its peak traced memory
+    Prints of the pipeline are swallowed
+    """
+    state = setup()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        run(state)
+        seconds = time.perf_counter() - start
+    result = {'seconds':seconds}
+    if memory:
+        state = setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            tracemalloc.start()
+            run(state)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        result.update({'peak_bytes':peak})
+    return result
+
+def kobo_stages(path: str, survey: Kobo, design: pd.DataFrame) -> dict:
+    """
+    (setup, run) pairs of the stages that start from a KoBo export, also in compact (and normalized) form
+    """
+    compact = Kobo(compact = True)
+    compact.questions = survey.questions
+    def read(survey = survey):
+        survey.read_form(path)
+        return survey
+    def parsed(survey = survey):
+        read(survey)
+        with contextlib.redirect_stdout(io.StringIO()):
+            survey.parse_form()
+        return survey
+    return {
+        'kobo.read_form':(lambda: survey, read),
+        'kobo.parse_form':(read, lambda survey: survey.parse_form()),
+        'kobo.parse_form.compact':(lambda: read(compact), lambda survey: survey.parse_form()),
+        'design_to_choices':(lambda: ChoiceExperiment(design), lambda exp: exp.design_to_choices()),
+        'encode_dataset':(lambda: (ChoiceExperiment(design), parsed()), lambda state: state[0].encode_dataset(state[1])),
+        'encode_dataset.compact':(lambda: (ChoiceExperiment(design, compact = True), parsed(compact)), lambda state: state[0].encode_dataset(state[1])),
+        'encode_dataset.normalized':(lambda: (ChoiceExperiment(design, compact = True), parsed(compact)), lambda state: state[0].encode_dataset(state[1], normalized = True)),
+        }
+
+def sheet_stages(grid: list, survey: Questionaire) -> dict:
+    """
+    (setup, run) pairs of the stages that start from the google sheet, served by an in-process fake
+    """
+    def connected():
+        fake = FakeSheets()
+        fake.grids['synthetic'] = [list(row) for row in grid]
+        survey.connect(fake, 'synthetic', per_minute = 0)
+        return survey
+    return {'questionaire.parse_form':(connected, lambda survey: survey.parse_form(full = True))}
+
+def run_benchmarks(sizes: list, nversions: int = 4, ncards: int = 6, nscenarios: int = 3, nattributes: int = 5, missing: float = 0.05, memory: bool = True, seed: int = 0) -> list:
+    """
+    Runs all stages for each number of respondents in sizes. Returns a list of records
+    """
+    records = []
+    design = synthetic.make_design(nversions = nversions, ncards = ncards, nscenarios = nscenarios, nattributes = nattributes, seed = seed)
+    with tempfile.TemporaryDirectory() as tempdir:
+        for nrespondents in sizes:
+            kobo = synthetic.build_survey(Kobo, ncards = ncards)
+            responses = synthetic.make_responses(kobo, design, nrespondents = nrespondents, missing = missing, seed = seed)
+            path = os.path.join(tempdir, f'kobo_{nrespondents}.xlsx')
+            synthetic.write_kobo_xlsx(responses, kobo, path)
+            sheets = synthetic.build_survey(Questionaire, ncards = ncards)
+            grid = synthetic.to_sheet_grid(synthetic.make_responses(sheets, design, nrespondents = nrespondents, missing = missing, seed = seed), sheets)
+            stages = kobo_stages(path, kobo, design)
+            stages.update(sheet_stages(grid, sheets))
+            for stage, (setup, run) in stages.items():
+                record = {'stage':stage, 'nrespondents':nrespondents, 'nversions':nversions, 'ncards':ncards, 'nscenarios':nscenarios, 'nattributes':nattributes, 'missing':missing}
+                record.update(measure(setup, run, memory = memory))
+                records.append(record)
+                print(f"{stage:<25} {nrespondents:>8} respondents {record['seconds']:>9.3f} s" + (f" {record['peak_bytes'] / 2**20:>9.1f} MiB" if memory else ''))
+    return records
+
+def save(records: list, directory: str = 'benchmark_results') -> str:
+    """
+    Writes the records with some information on the environment to a timestamped json file
+    """
+    os.makedirs(directory, exist_ok = True)
+    path = os.path.join(directory, time.strftime('%Y-%m-%d_%H-%M-%S') + '.json')
+    run = {'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'python':platform.python_version(), 'numpy':np.__version__, 'pandas':pd.__version__, 'machine':platform.machine(), 'records':records}
+    with open(path, 'w') as f:
+        json.dump(run, f, indent = 1)
+    return path
+
+def compare(old: str, new: str) -> pd.DataFrame:
+    """
+    Ratio new / old of time and peak memory per stage and size
+    """
+    frames = []
+    for path in (old, new):
+        with open(path) as f:
+            frames.append(pd.DataFrame(json.load(f)['records']).set_index(['stage','nrespondents']))
+    columns = [c for c in ['seconds','peak_bytes'] if c in frames[0].columns and c in frames[1].columns]
+    return (frames[1][columns] / frames[0][columns]).dropna(how = 'all')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'benchmark the pipeline on synthetic surveys')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = [100, 1000, 5000], help = 'numbers of respondents')
+    parser.add_argument('--versions', type = int, default = 4)
+    parser.add_argument('--cards', type = int, default = 6)
+    parser.add_argument('--scenarios', type = int, default = 3)
+    parser.add_argument('--attributes', type = int, default = 5)
+    parser.add_argument('--missing', type = float, default = 0.05, help = 'fraction of cells with a no-data value')
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the (slower) memory profiling pass')
+    parser.add_argument('--output', default = 'benchmark_results')
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD','NEW'), help = 'compare two stored runs instead')
+    args = parser.parse_args()
+    if args.compare:
+        print(compare(*args.compare).to_string())
+        sys.exit()
+    records = run_benchmarks(args.sizes, nversions = args.versions, ncards = args.cards, nscenarios = args.scenarios, nattributes = args.attributes, missing = args.missing, memory = not args.no_memory)
+    print(f'stored in {save(records, args.output)}')
@@ -0,0 +1,10 @@
+"""
+Reads the surveys that the groups encode each day (google sheets or KoBo exports), does quality control
+and generates the one-hot encoded database for the choice experiment statistical software
+The google client libraries are only imported when a sheet is accessed (Questionaire.establish_sheet_access)
+"""
+from .survey import Question, CustomField, ParsingPlan, QuestionIndex, Questionaire, Kobo, convert_to_bool
+from .schema import load_schema
+from .experiment import DesignStore, Choice, ChoiceExperiment, load_design
+from .estimation import ConditionalLogit
+from .instrument import profile
@@ -0,0 +1,175 @@
+"""
+Columnar, compressed and incremental store for backups of the raw sheet strings
+Each snapshot is a compressed .npz file with one string array per column. Only the first snapshot (and every
+full_every-th after that) holds all rows, the others hold just the rows that changed since the previous snapshot
+A snapshot is rebuilt by walking back along this chain, newest values first. Columns are decompressed only when accessed,
+so the rows that changed between two days of fieldwork can be found without loading everything
+"""
+import os
+import time
+import numpy as np
+
+def to_grid(strings: list) -> np.ndarray:
+    """
+    List of lists of strings (as the sheets api delivers them, with trailing empty cells cut off) to a rectangular array
+    """
+    ncols = max((len(row) for row in strings), default = 0)
+    grid = np.full((len(strings), ncols), '', dtype = object)
+    for i, row in enumerate(strings):
+        grid[i,:len(row)] = row
+    return grid.astype(str) if grid.size else np.empty((len(strings), ncols), dtype = '<U1')
+
+def to_strings(grid: np.ndarray) -> list:
+    """
+    Inverse of to_grid, trailing empty cells are cut off again
+    """
+    strings = []
+    for row in grid.tolist():
+        while row and row[-1] == '':
+            row.pop()
+        strings.append(row)
+    return strings
+
+def widen(grid: np.ndarray, ncols: int) -> np.ndarray:
+    if grid.shape[1] >= ncols:
+        return grid
+    return np.concatenate([grid, np.full((grid.shape[0], ncols - grid.shape[1]), '', dtype = grid.dtype)], axis = 1)
+
+class BackupStore(object):
+    """
+    Directory of snapshot files, ordered by their timestamped names
+    """
+    def __init__(self, directory: str, full_every: int = 10):
+        """
+        full_every bounds the length of the chain of deltas that has to be walked to rebuild a snapshot
+        """
+        self.directory = directory
+        self.full_every = full_every
+        self.cache = (None, None) # Name and grid of the last snapshot that was saved or fully loaded
+
+    def __repr__(self):
+        return f'BackupStore {self.directory}: {len(self.snapshots())} snapshots'
+
+    def snapshots(self) -> list:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.npz'))
+
+    def open(self, name: str):
+        """
+        Lazy access to one snapshot file: arrays are only read and decompressed when indexed
+        rows (changed row numbers), nrows, ncols, base (previous snapshot, empty when full) and c0, c1, ... (columns)
+        """
+        return np.load(os.path.join(self.directory, name))
+
+    def chain(self, name: str) -> list:
+        """
+        The snapshots needed to rebuild name, newest first, ending with a full one
+        A chain that refers back to itself cannot be rebuilt and raises a ValueError
+        """
+        names = []
+        while name:
+            if name in names:
+                raise ValueError(f'snapshot {names[0]} cannot be rebuilt, its chain of deltas loops back to {name}')
+            names.append(name)
+            with self.open(name) as snapshot:
+                name = str(snapshot['base'])
+        return names
+
+    def load(self, name: str, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Rebuilds the rectangular string grid of a snapshot. With rows only those row numbers (zero-based) are rebuilt
+        """
+        if rows is None and self.cache[0] == name:
+            return self.cache[1]
+        with self.open(name) as snapshot:
+            nrows, ncols = int(snapshot['nrows']), int(snapshot['ncols'])
+        target = np.arange(nrows) if rows is None else np.asarray(rows, dtype = np.int64)
+        target = target[target < nrows]
+        grid = np.full((len(target), ncols), '', dtype = object)
+        missing = np.ones(len(target), dtype = bool)
+        for link in self.chain(name):
+            if not missing.any():
+                break
+            with self.open(link) as snapshot:
+                present = snapshot['rows']
+                positions = np.searchsorted(present, target)
+                hit = missing & (positions < len(present))
+                hit[hit] = present[positions[hit]] == target[hit]
+                if hit.any():
+                    for j in range(min(ncols, int(snapshot['ncols']))):
+                        grid[hit, j] = snapshot[f'c{j}'][positions[hit]]
+                    missing &= ~hit
+        grid = grid.astype(str) if grid.size else np.empty(grid.shape, dtype = '<U1')
+        if rows is None:
+            self.cache = (name, grid)
+        return grid
+
+    def rows(self, name: str) -> list:
+        """
+        A snapshot as list of lists of strings, ready for uploading
+        """
+        return to_strings(self.load(name))
+
+    def save(self, strings: list, name: str = None) -> str:
+        """
+        Stores a new snapshot of the raw strings, holding only the rows that changed since the previous one
+        Timestamped names get a counter when a snapshot of the same second exists, an existing snapshot is never overwritten
+        Returns the name of the snapshot
+        """
+        os.makedirs(self.directory, exist_ok = True)
+        names = self.snapshots()
+        if name is None:
+            stamp = time.strftime('%Y-%m-%d_%H-%M-%S')
+            name = stamp + '.npz'
+            counter = 0
+            while name in names: # Sorts after the earlier ones of the same second
+                counter += 1
+                name = f'{stamp}_{counter:03d}.npz'
+        elif name in names:
+            raise FileExistsError(f'snapshot {name} already exists in {self.directory}')
+        grid = to_grid(strings)
+        ndeltas = 0
+        for previous in reversed(names): # Counting the deltas since the last full snapshot
+            with self.open(previous) as snapshot:
+                if not str(snapshot['base']):
+                    break
+            ndeltas += 1
+        if not names or ndeltas + 1 >= self.full_every:
+            base = ''
+            changed = np.arange(grid.shape[0])
+        else:
+            base = names[-1]
+            old = self.load(base)
+            ncols = max(grid.shape[1], old.shape[1])
+            common = min(grid.shape[0], old.shape[0])
+            differs = (widen(grid, ncols)[:common] != widen(old, ncols)[:common]).any(axis = 1)
+            changed = np.concatenate([np.nonzero(differs)[0], np.arange(common, grid.shape[0])])
+        columns = {f'c{j}':grid[changed, j] for j in range(grid.shape[1])}
+        np.savez_compressed(os.path.join(self.directory, name), rows = changed.astype(np.int64), nrows = np.int64(grid.shape[0]), ncols = np.int64(grid.shape[1]), base = np.str_(base), **columns)
+        self.cache = (name, grid)
+        return name
+
+    def diff(self, first: str, second: str) -> np.ndarray:
+        """
+        Row numbers (zero-based) whose strings differ between two snapshots
+        Only the rows touched by the deltas in between are rebuilt and compared
+        """
+        names = self.snapshots()
+        start, stop = sorted([names.index(first), names.index(second)])
+        candidates = set()
+        for name in names[start + 1:stop + 1]:
+            with self.open(name) as snapshot:
+                if not str(snapshot['base']): # A full snapshot does not tell what changed
+                    candidates.update(range(int(snapshot['nrows'])))
+                else:
+                    candidates.update(snapshot['rows'].tolist())
+        with self.open(first) as a, self.open(second) as b:
+            nrows = max(int(a['nrows']), int(b['nrows']))
+            candidates.update(range(min(int(a['nrows']), int(b['nrows'])), nrows)) # Rows present in only one of them
+        candidates = np.array(sorted(candidates), dtype = np.int64)
+        old, new = self.load(first, rows = candidates), self.load(second, rows = candidates)
+        ncols = max(old.shape[1], new.shape[1])
+        old = np.concatenate([widen(old, ncols), np.full((len(candidates) - len(old), ncols), '', dtype = old.dtype)])
+        new = np.concatenate([widen(new, ncols), np.full((len(candidates) - len(new), ncols), '', dtype = new.dtype)])
+        return candidates[(old != new).any(axis = 1)]
@@ -0,0 +1,96 @@
+"""
+Command line entry point of the pipeline:
+    python -m questions kobo ~/ownCloud/Tenerife/backups/ --output final.csv
+    python -m questions sheets --backup --output final.parquet
+    python -m questions sheets --sheetids <id of group 1> <id of group 2> --output final.csv
+    python -m questions kobo ~/ownCloud/Tenerife/backups/ --estimate --resamples 500
+    python -m questions restore 2020-03-18_09-12-47.npz
+"""
+import argparse
+from .instrument import profile
+
+DESIGN = '~/ownCloud/Tenerife/design_adapted.xlsx'
+
+def encode(survey, exp, args):
+    """
+    Shared tail of the kobo and sheets commands: quality control, encoding and export
+    """
+    if args.qc:
+        from .quality import QualityControl
+        report = QualityControl(survey.questions).check(survey).report(args.qc_by)
+        report.to_csv(args.qc)
+    if args.output:
+        nrows = exp.export_dataset(survey, args.output, chunksize = args.chunksize)
+        profile.say(f'wrote {nrows} rows to {args.output}')
+    if args.estimate:
+        exp.encode_dataset(survey, normalized = True) # Only the choices and attributes are needed
+        model = exp.estimate(optout = args.optout, nresamples = args.resamples, processes = getattr(args, 'processes', None))
+        print(model.summary().to_string())
+
+def kobo(args):
+    from .experiment import ChoiceExperiment, load_design
+    from .fieldwork import build_survey
+    exp = ChoiceExperiment(design = load_design(args.design), compact = args.compact)
+    survey = build_survey(ncards = exp.ncards)
+    survey.compact = args.compact
+    if len(args.paths) == 1 and args.paths[0].endswith('.xlsx'):
+        survey.read_form(args.paths[0])
+        survey.parse_form()
+    else:
+        survey.ingest(args.paths if len(args.paths) > 1 else args.paths[0], processes = args.processes)
+    encode(survey, exp, args)
+
+def sheets(args):
+    from .experiment import ChoiceExperiment, load_design
+    from .fieldwork import build_survey
+    from .survey import Questionaire
+    exp = ChoiceExperiment(design = load_design(args.design), compact = args.compact)
+    survey = build_survey(ncards = exp.ncards, kind = Questionaire)
+    survey.compact = args.compact
+    if args.sheetids:
+        survey.sync_sheets(args.sheetids, limit = args.limit)
+    else:
+        survey.establish_sheet_access()
+        if args.backup:
+            profile.say(f'backed up to {survey.backup_form()}')
+        survey.parse_form(full = True)
+    encode(survey, exp, args)
+
+def restore(args):
+    from .survey import Questionaire
+    survey = Questionaire()
+    survey.establish_sheet_access()
+    survey.restore_form(args.name)
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(prog = 'questions', description = 'parse, check and encode the choice experiment surveys')
+    parser.add_argument('--quiet', action = 'store_true', help = 'no status prints')
+    parser.add_argument('--profile', help = 'write stage timings and counters as json to this file')
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    for name, function, helptext in [('kobo', kobo, 'KoBo xlsx exports'), ('sheets', sheets, 'the google sheet')]:
+        command = commands.add_parser(name, help = f'process {helptext}')
+        if name == 'kobo':
+            command.add_argument('paths', nargs = '+', help = 'xlsx export(s), a directory or a glob pattern')
+            command.add_argument('--processes', type = int, default = None)
+        else:
+            command.add_argument('--backup', action = 'store_true', help = 'back up the sheet first')
+            command.add_argument('--sheetids', nargs = '+', help = 'fetch and merge these group sheets concurrently instead')
+            command.add_argument('--limit', type = int, default = 8, help = 'requests in flight with --sheetids')
+        command.add_argument('--design', default = DESIGN)
+        command.add_argument('--output', help = 'final long format dataset, .csv or .parquet')
+        command.add_argument('--chunksize', type = int, default = 1000, help = 'respondents per written chunk')
+        command.add_argument('--compact', action = 'store_true', help = 'categoricals and narrow integers, to save memory')
+        command.add_argument('--qc', help = 'write a quality control report (csv) to this file')
+        command.add_argument('--qc-by', default = 'Name_interviewer', choices = ['Name_interviewer','Group','Location','Date'])
+        command.add_argument('--estimate', action = 'store_true', help = 'print conditional logit estimates of the attributes')
+        command.add_argument('--optout', action = 'store_true', help = 'with --estimate, model cards without a pick as opting out')
+        command.add_argument('--resamples', type = int, default = 0, help = 'with --estimate, bootstrap resamples of the respondents')
+        command.set_defaults(function = function)
+    command = commands.add_parser('restore', help = 'restore a backup to the google sheet')
+    command.add_argument('name', help = 'name of the snapshot in the backup directory')
+    command.set_defaults(function = restore)
+    args = parser.parse_args(argv)
+    profile.verbose = not args.quiet
+    args.function(args)
+    if args.profile:
+        profile.to_json(args.profile)
@@ -0,0 +1,215 @@
+"""
+Quick estimates of the choice model during fieldwork, straight from ChoiceExperiment.final without the round trip
+to external choice modelling software. A conditional (McFadden) logit: on every card a respondent picks the scenario
+with the highest utility x'beta + e, so P(scenario j) = exp(x_j'beta) / sum_k exp(x_k'beta) over the scenarios of the card
+Maximum likelihood by Newton-Raphson with the analytic gradient and Hessian, all array based over the cards
+Standard errors from the Hessian, and by bootstrapping respondents (resampled as weights) in a process pool
+"""
+import os
+import math
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from .instrument import profile
+
+OUTER_LIMIT = 2**24 # Number of elements up to which the outer products of the attributes are precomputed (128 MiB)
+
+class ConditionalLogit(object):
+    """
+    The choice data of a final dataset (index with version, card and scenario levels, columns id, choice and the attributes)
+    arranged per card of a respondent (a choice task) in arrays of shape (n_scenarios, n_tasks, n_attributes). With the
+    few scenarios on the leading axis the reductions over the scenarios of a task are elementwise operations on long rows
+    Scenarios that are not in the design (missing attributes) are unavailable. Cards on which nothing was chosen
+    (the none option, or no answer) are dropped, or with optout modelled as choosing an extra alternative with
+    all attributes zero and its own constant. Note that unanswered cards then also count as opting out
+    """
+    def __init__(self, final: pd.DataFrame, attributes: list, optout: bool = False):
+        self.names = list(attributes) + (['optout'] if optout else [])
+        ids = final['id'].to_numpy()
+        cards = final.index.get_level_values('card').to_numpy()
+        scenarios = final.index.get_level_values('scenario').to_numpy()
+        order = np.lexsort((scenarios, cards, ids))
+        ids, cards = ids[order], cards[order]
+        values = final[list(attributes)].to_numpy(dtype = np.float64, na_value = np.nan)[order]
+        chosen = final['choice'].to_numpy(dtype = np.int64, na_value = 0)[order] == 1
+        # Task number and position within the task of every row
+        first = np.ones(len(ids), dtype = bool)
+        first[1:] = (ids[1:] != ids[:-1]) | (cards[1:] != cards[:-1])
+        task = np.cumsum(first) - 1
+        starts = np.flatnonzero(first)
+        position = np.arange(len(ids)) - starts[task]
+        ntasks, nalternatives = len(starts), (position.max() + 1 if len(ids) else 0)
+        X = np.zeros((ntasks, nalternatives + optout, len(self.names)))
+        available = np.zeros((ntasks, nalternatives + optout), dtype = bool)
+        choices = np.zeros((ntasks, nalternatives + optout), dtype = bool)
+        present = ~np.isnan(values).any(axis = 1)
+        X[task, position, :len(attributes)] = np.where(present[:,np.newaxis], values, 0)
+        available[task, position] = present
+        choices[task, position] = chosen & present
+        if optout:
+            X[:, -1, -1] = 1
+            available[:, -1] = True
+            choices[:, -1] = np.bincount(task, weights = chosen, minlength = ntasks) == 0 # Not a pick of a scenario outside the design
+        keep = choices.sum(axis = 1) == 1
+        profile.count('estimate.tasks', int(keep.sum()))
+        profile.count('estimate.dropped', int((~keep).sum()))
+        self.X = np.ascontiguousarray(X[keep].transpose(1, 0, 2))
+        self.flat = self.X.reshape(-1, len(self.names)) # (n_scenarios * n_tasks, n_attributes), for matrix products
+        self.available = np.ascontiguousarray(available[keep].T)
+        self.complete = bool(self.available.all())
+        self.ntasks = self.X.shape[1]
+        self.chosen = choices[keep].argmax(axis = 1)
+        self.picked = self.chosen * self.ntasks + np.arange(self.ntasks) # Flat positions of the chosen scenarios
+        self.Xchosen = self.flat[self.picked]
+        self.outer = self.outer_products()
+        self.respondent, respondents = pd.factorize(ids[starts][keep])
+        self.nrespondents = len(respondents)
+        self.params = None
+        self.resamples = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['outer'] = None # Cheaper to rebuild in a worker than to ship
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.outer = self.outer_products()
+
+    def outer_products(self) -> np.ndarray:
+        """
+        Outer products of the attribute rows, which turn the second moment in the Hessian into one matrix-vector product
+        None when they would take more than OUTER_LIMIT elements
+        """
+        nattributes = len(self.names)
+        if self.flat.size * nattributes > OUTER_LIMIT:
+            return None
+        return (self.flat[:,:,np.newaxis] * self.flat[:,np.newaxis,:]).reshape(-1, nattributes**2)
+
+    def __repr__(self):
+        return f'ConditionalLogit of {self.ntasks} choices by {self.nrespondents} respondents on {self.names}'
+
+    def loglikelihood(self, beta: np.ndarray, weights: np.ndarray = None) -> tuple:
+        """
+        The (weighted) log-likelihood with its gradient and Hessian at beta. Weights are per task
+        """
+        w = np.ones(self.ntasks) if weights is None else weights
+        V = (self.flat @ beta).reshape(self.available.shape)
+        if not self.complete:
+            V = np.where(self.available, V, -np.inf)
+        top = V.max(axis = 0)
+        E = np.exp(V - top)
+        total = E.sum(axis = 0)
+        P = E / total
+        ll = w @ (V.ravel()[self.picked] - top - np.log(total))
+        mean = np.einsum('jt,jtk->tk', P, self.X) # Probability weighted attributes per task
+        gradient = w @ (self.Xchosen - mean)
+        # Minus the weighted sum over tasks of the covariance of the attributes under P
+        weighted = (P * w).ravel()
+        if self.outer is not None:
+            moment = (weighted @ self.outer).reshape(len(beta), len(beta))
+        else:
+            moment = self.flat.T @ (self.flat * weighted[:,np.newaxis])
+        hessian = (mean * w[:,np.newaxis]).T @ mean - moment
+        return ll, gradient, hessian
+
+    def newton(self, weights: np.ndarray = None, start: np.ndarray = None, tol: float = 1e-10, maxiter: int = 100) -> tuple:
+        """
+        Maximizes the log-likelihood, with step halving when a full Newton step does not improve it
+        Returns the parameters, the log-likelihood, the Hessian, the number of iterations and whether it converged
+        within maxiter iterations. A singular Hessian raises a ValueError
+        """
+        beta = np.zeros(len(self.names)) if start is None else np.array(start, dtype = np.float64)
+        ll, gradient, hessian = self.loglikelihood(beta, weights)
+        converged = False
+        for iteration in range(1, maxiter + 1):
+            try:
+                step = np.linalg.solve(-hessian, gradient)
+            except np.linalg.LinAlgError:
+                raise ValueError(f'the parameters {self.names} are not identified by these choices (singular Hessian)')
+            if gradient @ step < tol: # Newton decrement
+                converged = True
+                break
+            t = 1.0
+            while True:
+                candidate = beta + t * step
+                new = self.loglikelihood(candidate, weights)
+                if new[0] >= ll or t < 1e-10:
+                    break
+                t /= 2
+            beta = candidate
+            ll, gradient, hessian = new
+        return beta, ll, hessian, iteration, converged
+
+    def fit(self, tol: float = 1e-10, maxiter: int = 100) -> np.ndarray:
+        """
+        Estimates the parameters, stored with the log-likelihood and the analytic covariance (the inverse of minus the Hessian)
+        Warns when the estimate did not converge (self.converged is then False)
+        """
+        with profile.stage('estimate.fit'):
+            self.params, self.loglik, hessian, self.iterations, self.converged = self.newton(tol = tol, maxiter = maxiter)
+            self.covariance = np.linalg.inv(-hessian)
+        if not self.converged:
+            warnings.warn(f'the estimate of {self.names} did not converge in {maxiter} iterations', RuntimeWarning)
+        return self.params
+
+    def bootstrap(self, nresamples: int = 200, processes: int = None, seed: int = 0) -> np.ndarray:
+        """
+        Re-estimates the model on nresamples resamples of the respondents (with replacement, all cards of a respondent together)
+        The resamples are expressed as weights, so the arrays are shared instead of copied, and each fit starts at the estimate
+        They are spread in chunks over a process pool (processes = 1 runs them here). Results only depend on the seed
+        Returns (and stores in self.resamples) the parameters of every resample. Resamples whose fit failed (singular
+        Hessian, or no convergence) are kept as rows of NaN, and left out of the bootstrap statistics in summary
+        """
+        if self.params is None:
+            self.fit()
+        seeds = np.random.SeedSequence(seed).spawn(nresamples)
+        with profile.stage('estimate.bootstrap'):
+            if processes == 1:
+                self.resamples = fit_resamples(self, seeds)
+            else:
+                nchunks = max(min((processes or os.cpu_count() or 1) * 4, nresamples), 1)
+                chunks = [seeds[i::nchunks] for i in range(nchunks)]
+                with ProcessPoolExecutor(max_workers = processes) as executor:
+                    results = list(executor.map(fit_resamples, [self] * nchunks, chunks))
+                # Back in the order of the seeds
+                self.resamples = np.empty((nresamples, len(self.names)))
+                for i, result in enumerate(results):
+                    self.resamples[i::nchunks] = result
+        failed = int(np.isnan(self.resamples).any(axis = 1).sum())
+        profile.count('estimate.resamples', nresamples)
+        profile.count('estimate.failed', failed)
+        if failed:
+            warnings.warn(f'the fit failed on {failed} of {nresamples} resamples, these are left out', RuntimeWarning)
+        return self.resamples
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Coefficients with their analytic standard errors, z values and p values, plus bootstrap standard errors and
+        95% percentile intervals when resamples are available
+        """
+        if self.params is None:
+            self.fit()
+        se = np.sqrt(np.diag(self.covariance))
+        z = self.params / se
+        table = pd.DataFrame({'coef':self.params, 'se':se, 'z':z, 'p':[math.erfc(abs(value) / math.sqrt(2)) for value in z]}, index = pd.Index(self.names, name = 'attribute'))
+        if self.resamples is not None:
+            table['bootstrap_se'] = np.nanstd(self.resamples, axis = 0, ddof = 1)
+            table['lower'], table['upper'] = np.nanpercentile(self.resamples, [2.5, 97.5], axis = 0)
+        return table
+
+def fit_resamples(model: ConditionalLogit, seeds: list) -> np.ndarray:
+    """
+    Worker of ConditionalLogit.bootstrap, one fit per seed. A failed fit gives a row of NaN
+    """
+    rows = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        counts = np.bincount(rng.integers(0, model.nrespondents, model.nrespondents), minlength = model.nrespondents)
+        try:
+            beta, ll, hessian, iterations, converged = model.newton(weights = counts[model.respondent].astype(np.float64), start = model.params)
+        except ValueError: # Singular Hessian, e.g. an attribute without variation among the resampled respondents
+            converged = False
+        rows.append(beta if converged else np.full(len(model.names), np.nan))
+    return np.array(rows).reshape(len(seeds), len(model.names))
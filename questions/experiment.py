@@ -0,0 +1,367 @@
+"""
+The choice experiment side of the pipeline: the design supplied by MK and the one-hot encoding
+of the chosen scenarios into the long format for the statistical software
+"""
+import os
+import hashlib
+import pandas as pd
+import numpy as np
+from .survey import Questionaire, align_dtypes
+from .instrument import profile
+
+def load_design(path: str, cachedir: str = '~/.cache/questions', content_hash: bool = False) -> pd.DataFrame:
+    """
+    Reads the design spreadsheet (index columns version, card, scenario), through a cache in fast binary (pickle) form
+    The cache is keyed on the path, size and modification time of the file, or with content_hash on a hash of its bytes,
+    so repeated runs skip the xlsx parse until the spreadsheet changes
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    if content_hash:
+        with open(path, 'rb') as f:
+            key = hashlib.sha1(f.read()).hexdigest()
+    else:
+        stat = os.stat(path)
+        key = hashlib.sha1(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+    cachedir = os.path.expanduser(cachedir)
+    cached = os.path.join(cachedir, f'design_{key}.pickle')
+    if os.path.exists(cached):
+        with profile.stage('design.cached'):
+            return pd.read_pickle(cached)
+    with profile.stage('design.xlsx'):
+        design = pd.read_excel(path, index_col = [0,1,2], header = 0)
+    os.makedirs(cachedir, exist_ok = True)
+    design.to_pickle(cached)
+    return design
+
+class DesignStore(object):
+    """
+    Dense array representation of the design supplied by MK
+    The attributes sit in a tensor of shape (n_versions, n_cards, n_scenarios, n_attributes), indexed by the integer codes
+    of the version, card and scenario numbers. Combinations that are absent from the design hold np.nan
+    """
+    levelnames = ['version','card','scenario']
+
+    def __init__(self, design: pd.DataFrame):
+        self.attributes = design.columns.tolist()
+        self.dtypes = design.dtypes
+        self.levels = [np.unique(design.index.get_level_values(name)) for name in self.levelnames]
+        self.positions = [{level:code for code, level in enumerate(levels.tolist())} for levels in self.levels] # For O(1) scalar lookup
+        shape = tuple(len(levels) for levels in self.levels)
+        codes = tuple(np.searchsorted(levels, design.index.get_level_values(name)) for levels, name in zip(self.levels, self.levelnames))
+        values = design.to_numpy()
+        self.present = np.zeros(shape, dtype = bool)
+        self.present[codes] = True
+        self.complete = bool(self.present.all())
+        if self.complete:
+            self.tensor = np.empty(shape + (len(self.attributes),), dtype = values.dtype)
+        else: # Room for np.nan
+            self.tensor = np.full(shape + (len(self.attributes),), np.nan, dtype = np.result_type(values.dtype, np.float64))
+        self.tensor[codes] = values
+        # Smallest integer dtypes of the integer attributes over the whole design, the same for every batch of the data
+        self.compact_dtypes = {column:pd.to_numeric(design[column], downcast = 'integer').dtype for column in self.attributes if design[column].dtype.kind in 'iu'}
+
+    def __repr__(self):
+        return f'DesignStore {self.tensor.shape[:3]} (version, card, scenario) with attributes {self.attributes}'
+
+    def lookup(self, version: int, card: int, scenario: int) -> np.ndarray:
+        """
+        The attribute row of a single (version, card, scenario)
+        """
+        return self.tensor[self.positions[0][version], self.positions[1][card], self.positions[2][scenario]]
+
+    def codes(self, versions: np.ndarray, cards: np.ndarray, scenarios: np.ndarray) -> tuple:
+        """
+        Integer codes of a batch of (version, card, scenario) triples, plus a mask of the triples that are in the design
+        """
+        codes = []
+        valid = np.ones(len(versions), dtype = bool)
+        for levels, values in zip(self.levels, (versions, cards, scenarios)):
+            values = np.asarray(values)
+            code = np.minimum(np.searchsorted(levels, values), len(levels) - 1)
+            valid &= levels[code] == values
+            codes.append(code)
+        codes = tuple(codes)
+        valid &= self.present[codes]
+        return codes, valid
+
+    def gather(self, versions: np.ndarray, cards: np.ndarray, scenarios: np.ndarray) -> np.ndarray:
+        """
+        Vectorized gather of the attribute rows of a batch of (version, card, scenario) triples, shape (n, n_attributes)
+        Triples that are not in the design get np.nan
+        """
+        codes, valid = self.codes(versions, cards, scenarios)
+        rows = self.tensor[codes]
+        if not valid.all():
+            rows = rows.astype(np.result_type(rows.dtype, np.float64))
+            rows[~valid] = np.nan
+        return rows
+
+    def frame(self, index: pd.MultiIndex) -> pd.DataFrame:
+        """
+        The attributes for an index with version, card and scenario levels, with the dtypes of the design where possible
+        """
+        rows = self.gather(*[index.get_level_values(name).to_numpy() for name in self.levelnames])
+        frame = pd.DataFrame(rows, index = index, columns = self.attributes)
+        if not frame.isna().to_numpy().any():
+            frame = frame.astype(self.dtypes.to_dict())
+        return frame
+
+class Choice(object):
+    """
+    Lightweight view on one (version, card, scenario) of the design store
+    """
+    __slots__ = ('store', 'version', 'card', 'scenario')
+
+    def __init__(self, store: DesignStore, version: int, card: int, scenario: int):
+        self.store = store
+        self.version = version
+        self.card = card
+        self.scenario = scenario
+
+    @property
+    def attrs(self) -> list:
+        return self.store.lookup(self.version, self.card, self.scenario).tolist()
+
+    @property
+    def n_attrs(self) -> int:
+        return len(self.store.attributes)
+
+    def __repr__(self):
+        return f'{self.version}.{self.card}.{self.scenario}: {self.attrs}'
+
+class ChoiceExperiment(object):
+    """
+    Class to contain the information of the choice experiment:
+    A set of n_versions of containing n_cards containing n_scenarios with each a choice that is defined by number of weighted attributes
+    """
+    def __init__(self, design, compact: bool = False):
+        """
+        Compact gives the encoded output narrow dtypes (int8 choice, downcast id and integer attributes) and attaches the
+        attributes in place, so that self.encoded and self.final are one and the same frame
+        """
+        self.choices = list()
+        self.design = design
+        self.compact = compact
+        self.store = DesignStore(design)
+        self.fingerprint = hashlib.sha1(pd.util.hash_pandas_object(design, index = True).to_numpy().tobytes() + repr(list(design.columns)).encode()).hexdigest()
+        self.nversions, self.ncards, self.nscenarios = self.store.tensor.shape[:3]
+    
+    def __repr__(self):
+        return f'{self.choices}'
+
+    def design_to_choices(self):
+        """
+        This method will be the bridge between the design dataformat supplied by MK
+        The choices are views on the design store, in (version, card, scenario) order
+        """
+        versions, cards, scenarios = self.store.levels
+        for i, j, k in zip(*np.nonzero(self.store.present)):
+            self.choices.append(Choice(self.store, versions[i].item(), cards[j].item(), scenarios[k].item()))
+    
+    def onehot_choices(self, picks: np.ndarray) -> np.ndarray:
+        """
+        Array based one-hot encoding of the chosen scenarios
+        picks is a float matrix of shape (n_respondents, n_cards) with the scenario number picked on each card
+        Returns an int32 array of shape (n_respondents, n_cards, n_scenarios)
+        Currently we use np.nan to designate the no-pick scenario, so no-data becomes no-choice
+        A pick of nscenarios + 1 (none chosen) or any other out-of-range number also leaves the card at zero
+        """
+        scenarios = np.arange(1, self.nscenarios + 1, dtype = picks.dtype)
+        return (picks[:,:,np.newaxis] == scenarios).astype(np.int32) # nan compares unequal to everything
+    
+    def find_version_column(self, questionaire: Questionaire) -> str:
+        """
+        Version column determined by text, through the compiled question index. Scenario picks should be subquestions of it, are found by id. 
+        """
+        version_column = questionaire.compile_index().version
+        if version_column is None:
+            raise KeyError('no version question in the questionaire')
+        profile.say(f'found version in column {version_column} of data')
+        return version_column
+
+    def id_dtype(self, index: pd.Index) -> np.dtype:
+        """
+        The dtype of the id column: in compact mode the smallest integer dtype that holds all ids in index
+        """
+        ids = index.to_numpy()
+        if not self.compact or not len(ids) or ids.dtype.kind not in 'iu':
+            return ids.dtype
+        return np.result_type(np.min_scalar_type(ids.min()), np.min_scalar_type(ids.max()))
+
+    def long_format(self, data: pd.DataFrame, version_column: str, columns: list = None, idtype: np.dtype = None) -> pd.DataFrame:
+        """
+        One-hot encoded long format of the data: one row per respondent, card and scenario with the choice (0/1),
+        the respondent id and all data columns (or only those in columns), indexed by (version, card, scenario)
+        idtype is the dtype of the id column (see id_dtype), to be taken from all respondents when data is only a batch of them
+        """
+        with profile.stage('encode.onehot'):
+            # Gather the scenario picks of all cards into one float matrix (n_respondents, n_cards), missing values become np.nan
+            cardcols = ['.'.join([version_column,str(card)]) for card in range(1,self.ncards + 1)] # assumes that the fifth card column is e.g. '5.5' if the version column was 5
+            picks = data.reindex(columns = cardcols).astype('float64').to_numpy() # An absent card column counts as no-pick for everyone
+            # We will drop entries without a version number (useless for the experiment)
+            keep = data[version_column].notna().to_numpy()
+            data = data.loc[keep]
+            onehot = self.onehot_choices(picks[keep])
+        with profile.stage('encode.stack'):
+            # Build the long format directly: each respondent row is repeated for every (card, scenario)
+            # The index gets version added to the levels (to be merged with attributes) and the id becomes a column
+            nrespondents = len(data)
+            rows = np.repeat(np.arange(nrespondents), self.ncards * self.nscenarios)
+            encoded = (data if columns is None else data[list(columns)]).iloc[rows]
+            encoded.index = pd.MultiIndex.from_arrays([data[version_column].astype('int64').to_numpy()[rows], 
+                np.tile(np.repeat(np.arange(1,self.ncards + 1), self.nscenarios), nrespondents), 
+                np.tile(np.arange(1,self.nscenarios + 1), nrespondents * self.ncards)], names = ['version','card','scenario'])
+            encoded.insert(0, 'choice', pd.array(onehot.ravel(), dtype = pd.Int8Dtype() if self.compact else pd.Int32Dtype()))
+            ids = data.index.to_numpy().astype(self.id_dtype(data.index) if idtype is None else idtype, copy = False)
+            encoded.insert(0, 'id', ids[rows])
+        profile.count('encode.respondents', nrespondents)
+        profile.count('encode.dropped', len(keep) - nrespondents)
+        profile.count('encode.rows', len(encoded))
+        return encoded
+
+    def attach_attributes(self, encoded: pd.DataFrame) -> pd.DataFrame:
+        """
+        The final combination with the designed attributes based on version number
+        A single indexed gather from the design store, entries with unknown versions get np.nan (as a left merge would)
+        """
+        with profile.stage('encode.attributes'):
+            attributes = self.store.frame(encoded.index)
+            if not self.compact:
+                return pd.concat([encoded, attributes], axis = 1)
+            for column in attributes.columns: # Added to encoded itself instead of to a concatenated copy
+                values = attributes[column]
+                encoded[column] = values.astype(self.store.compact_dtypes[column]) if values.dtype.kind in 'iu' else values
+            return encoded
+
+    def encode_dataset(self, questionaire: Questionaire, normalized: bool = False, cache: str = None):
+        """
+        Expands the supplied data with a one-hot encoding of 
+        chosen scenarios. (new column with choice)
+        Assumes that the data has a unique integer respondent id index
+        It also searches for the column with the version number
+        Based on that id it appends the attribute weights from the design
+        Normalized keeps self.final narrow (id, choice and the attributes) instead of repeating the answers of a respondent
+        on every card and scenario. The answers are then in self.respondents, joined by id (see denormalize)
+        With cache (a file path) only new and changed respondents are encoded, see encode_cached
+        """
+        version_column = self.find_version_column(questionaire)
+        data = questionaire.data
+        assert data.index.name == 'id'
+        self.respondents = data if normalized else None
+        columns = [] if normalized else None
+        if cache is not None:
+            self.final = self.encode_cached(questionaire, version_column, cache, columns = columns)
+            self.encoded = self.final if self.compact else self.final.drop(columns = self.store.attributes)
+        else:
+            self.encoded = self.long_format(data, version_column, columns = columns)
+            self.final = self.attach_attributes(self.encoded)
+
+    def encode_cached(self, questionaire: Questionaire, version_column: str, cache: str, columns: list = None) -> pd.DataFrame:
+        """
+        The final dataset through a persistent cache, in which every respondent is keyed by id and a hash of its parsed row
+        Only respondents that are new or whose row changed are encoded, and spliced into the cached rows. Those of removed
+        respondents are dropped. The cache is invalidated as a whole when the design, the questions or the columns change
+        The result is the same (also in row order) as without the cache
+        """
+        data = questionaire.data
+        schema = [(key, str(q.text), str(q.dtype)) for key, q in questionaire.questions.items()]
+        key = hashlib.sha1(repr((self.fingerprint, schema, [(c, str(data[c].dtype)) for c in data.columns], columns, self.compact)).encode()).hexdigest()
+        with profile.stage('encode.hash'):
+            hashes = pd.util.hash_pandas_object(data, index = True)
+        cached = None
+        if os.path.exists(cache):
+            with profile.stage('encode.cache.read'):
+                stored = pd.read_pickle(cache)
+            if stored[0] == key:
+                cached = stored
+            else:
+                profile.say('design or questions changed, encoding cache invalidated')
+        if cached is None:
+            final = self.attach_attributes(self.long_format(data, version_column, columns = columns))
+            changed = data.index
+        else:
+            old_hashes, old_final = cached[1], cached[2]
+            common = hashes.index.intersection(old_hashes.index)
+            unchanged = common[(hashes.loc[common].to_numpy() == old_hashes.loc[common].to_numpy())]
+            changed = hashes.index.difference(unchanged, sort = False)
+            if not len(changed) and len(unchanged) == len(old_hashes): # Nothing to do
+                profile.count('encode.cache.unchanged', len(data))
+                return old_final
+            kept = old_final.loc[old_final['id'].isin(unchanged).to_numpy()]
+            idtype = self.id_dtype(data.index)
+            if len(changed):
+                new = self.attach_attributes(self.long_format(data.loc[changed], version_column, columns = columns, idtype = idtype))
+                final = pd.concat(align_dtypes([kept, new])) if len(kept) else new
+            else:
+                final = kept
+            # Respondents in the order of data, within a respondent the cards and scenarios keep their order
+            order = np.argsort(data.index.get_indexer(final['id'].to_numpy()), kind = 'stable')
+            final = final.iloc[order]
+            if final['id'].dtype != idtype: # The cached ids were narrower or wider than those of all respondents now
+                final['id'] = final['id'].astype(idtype)
+        profile.count('encode.cache.changed', len(changed))
+        profile.count('encode.cache.unchanged', len(data) - len(changed))
+        with profile.stage('encode.cache.write'):
+            pd.to_pickle((key, hashes, final), cache)
+        return final
+
+    def estimate(self, optout: bool = False, nresamples: int = 0, processes: int = None, seed: int = 0):
+        """
+        Fits a conditional logit of the choices on the design attributes in self.final (see estimation.py),
+        with bootstrap standard errors from nresamples resamples of the respondents when nresamples > 0
+        Returns the fitted model, of which summary() gives the table of estimates
+        """
+        from .estimation import ConditionalLogit
+        model = ConditionalLogit(self.final, self.store.attributes, optout = optout)
+        model.fit()
+        if nresamples:
+            model.bootstrap(nresamples, processes = processes, seed = seed)
+        return model
+
+    def denormalize(self) -> pd.DataFrame:
+        """
+        The wide final dataset (as encode_dataset without normalized) from a normalized one
+        """
+        answers = self.respondents.reindex(self.final['id'].to_numpy())
+        answers.index = self.final.index
+        return pd.concat([self.final[['id','choice']], answers, self.final.drop(columns = ['id','choice'])], axis = 1)
+
+    def export_dataset(self, questionaire: Questionaire, path: str, chunksize: int = 1000) -> int:
+        """
+        Writes the final long format dataset to disk without ever holding all of it in memory
+        The respondents are encoded and written in chunks of chunksize, so peak memory is bounded by the chunk size
+        The format follows from the extension: .csv or .parquet (columnar, requires pyarrow)
+        Rows are sorted by (version, id, card, scenario), columns are version, card, scenario, id, choice, the data columns and the attributes
+        Returns the number of rows written
+        """
+        version_column = self.find_version_column(questionaire)
+        data = questionaire.data
+        assert data.index.name == 'id'
+        data = data.loc[data[version_column].notna()]
+        # Sorting the respondents up front makes every chunk, and therefore the whole file, sorted
+        order = np.lexsort((data.index.to_numpy(), data[version_column].astype('int64').to_numpy()))
+        idtype = self.id_dtype(data.index) # Of all respondents, so that every chunk has the same schema
+        parquet = path.endswith('.parquet')
+        if parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            writer = None
+        nrows = 0
+        try:
+            for start in range(0, max(len(order), 1), chunksize):
+                chunk = self.attach_attributes(self.long_format(data.iloc[order[start:start + chunksize]], version_column, idtype = idtype)).reset_index()
+                with profile.stage('export.write'):
+                    if parquet:
+                        if writer is None: # The schema of the first chunk is imposed on the others
+                            table = pa.Table.from_pandas(chunk, preserve_index = False)
+                            writer = pq.ParquetWriter(path, table.schema)
+                        else:
+                            table = pa.Table.from_pandas(chunk, schema = writer.schema, preserve_index = False)
+                        writer.write_table(table)
+                    else:
+                        chunk.to_csv(path, mode = 'w' if start == 0 else 'a', header = start == 0, index = False)
+                nrows += len(chunk)
+        finally:
+            if parquet and writer is not None:
+                writer.close()
+        return nrows
@@ -0,0 +1,16 @@
+"""
+The questionaire of the Tenerife fieldwork, as it is entered in KoBo. The questions are declared in fieldwork.json
+"""
+import os
+from .survey import Kobo
+from .schema import load_schema
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fieldwork.json')
+
+def build_survey(ncards: int, kind: type = Kobo, cachedir: str = '~/.cache/questions'):
+    """
+    Registers the fieldwork questions, with one scenario pick per choice card as subquestions of the version question
+    Ids are fixed in the schema, so they do not depend on the order in which surveys are built
+    kind is Kobo or Questionaire, the latter (google sheets) has no custom fields
+    """
+    return load_schema(SCHEMA, ncards = ncards, kind = kind, cachedir = cachedir)
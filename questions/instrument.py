@@ -0,0 +1,95 @@
+"""
+Stage-level timing and counters for the pipeline. All modules report to the one profile below:
+    from questions.instrument import profile
+    profile.reset()
+    survey.parse_form()
+    print(profile.to_json())
+Each stage accumulates its number of calls and wall time, and with profile.memory = True also the change in
+traced (tracemalloc) memory, which slows everything down. Counters track rows, cells and conversion outcomes
+The status prints of the pipeline go through profile.say, so profile.verbose = False silences them
+"""
+import json
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class Profile(object):
+
+    def __init__(self, verbose: bool = True, memory: bool = False):
+        self.verbose = verbose
+        self._memory = False
+        self.memory = memory
+        self.reset()
+
+    def __repr__(self):
+        return f'Profile of {len(self.stages)} stages and {len(self.counters)} counters'
+
+    @property
+    def memory(self) -> bool:
+        return self._memory
+
+    @memory.setter
+    def memory(self, value: bool):
+        """
+        Starts or stops the tracing of memory allocations
+        """
+        if value and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not value and self._memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._memory = bool(value)
+
+    def reset(self):
+        self.stages = OrderedDict() # name -> calls, seconds, memory (bytes, None when not traced)
+        self.counters = OrderedDict()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the enclosed block, and records the change in traced memory when memory is on
+        Stages can be nested, the outer stage then includes the inner ones
+        """
+        tracing = self._memory and tracemalloc.is_tracing()
+        before = tracemalloc.get_traced_memory()[0] if tracing else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            record = self.stages.setdefault(name, {'calls':0, 'seconds':0.0, 'memory':None})
+            record['calls'] += 1
+            record['seconds'] += seconds
+            if tracing:
+                record['memory'] = (record['memory'] or 0) + tracemalloc.get_traced_memory()[0] - before
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def say(self, message: str):
+        if self.verbose:
+            print(message)
+
+    def to_dict(self) -> dict:
+        return {'stages':{name:dict(record) for name, record in self.stages.items()}, 'counters':dict(self.counters)}
+
+    def to_json(self, path: str = None) -> str:
+        """
+        The stages and counters as json, also written to path when given
+        """
+        text = json.dumps(self.to_dict(), indent = 1)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def report(self):
+        """
+        The stages as a DataFrame, slowest first
+        """
+        import pandas as pd
+        frame = pd.DataFrame.from_dict(self.stages, orient = 'index', columns = ['calls','seconds','memory'])
+        frame.index.name = 'stage'
+        return frame.sort_values('seconds', ascending = False)
+
+profile = Profile()
@@ -0,0 +1,135 @@
+"""
+Quality control of the parsed survey data and statistics on how each group performs
+Per respondent a compact numeric record is derived in one vectorized pass (missing answers, conversion failures,
+answered choice cards, interview duration). These are summed per (Name_interviewer, Group, Location, Date),
+and these sums are kept up to date incrementally: new or corrected respondents only touch their own groups
+Reports per interviewer, group, location or date are rolled up from the sums
+"""
+import numpy as np
+import pandas as pd
+from .survey import QuestionIndex
+
+KEYS = ['Name_interviewer', 'Group', 'Location', 'Date']
+
+class QualityControl(object):
+
+    def __init__(self, questions: dict):
+        """
+        questions is the registry of a Questionaire or Kobo. The choice cards are the subquestions of the version question
+        """
+        self.questions = [key for key in questions if key not in KEYS]
+        self.cards = QuestionIndex(questions).cards
+        self.records = pd.DataFrame() # Per respondent, the contribution to the sums
+        self.sums = pd.DataFrame() # Per (Name_interviewer, Group, Location, Date)
+
+    def __repr__(self):
+        return f'QualityControl of {len(self.records)} respondents in {len(self.sums)} groups'
+
+    def derive(self, data: pd.DataFrame, failed: pd.DataFrame = None) -> pd.DataFrame:
+        """
+        The per respondent records: the group keys and numeric columns that can be summed
+        failed is the per cell conversion failure mask of the parsing plan for the same rows
+        """
+        keys = pd.DataFrame({key:(data[key] if key in data.columns else pd.Series(pd.NA, index = data.index, dtype = object)) for key in KEYS}, index = data.index)
+        for key in KEYS: # Compact data holds categoricals, which would group in order of appearance and differ between batches
+            if isinstance(keys[key].dtype, pd.CategoricalDtype):
+                keys[key] = keys[key].astype(object)
+        if 'Date' in data.columns:
+            keys['Date'] = pd.to_datetime(data['Date'], errors = 'coerce').dt.normalize()
+        blocks = [keys, pd.DataFrame({'entries':np.ones(len(data), dtype = np.int32)}, index = data.index)]
+        columns = [c for c in self.questions if c in data.columns]
+        blocks.append(pd.DataFrame(data[columns].isna().to_numpy(dtype = np.int32), index = data.index, columns = [f'missing:{c}' for c in columns]))
+        if failed is not None and len(failed.columns):
+            failed = failed.reindex(index = data.index, columns = columns, fill_value = False)
+            blocks.append(pd.DataFrame(failed.to_numpy(dtype = np.int32), index = data.index, columns = [f'failed:{c}' for c in columns]))
+        cards = [c for c in self.cards if c in data.columns]
+        if cards:
+            answered = data[cards].notna().to_numpy().sum(axis = 1)
+            blocks.append(pd.DataFrame({'cards_answered':answered, 'cards_complete':(answered == len(self.cards)).astype(np.int32)}, index = data.index))
+        if 'start' in data.columns and 'end' in data.columns:
+            duration = (pd.to_datetime(data['end'], errors = 'coerce') - pd.to_datetime(data['start'], errors = 'coerce')).dt.total_seconds() / 60
+            blocks.append(pd.DataFrame({'duration':duration.fillna(0).to_numpy(), 'durations':duration.notna().to_numpy(dtype = np.int32)}, index = data.index)) # durations counts the known ones, for the mean
+        return pd.concat(blocks, axis = 1)
+
+    def group(self, records: pd.DataFrame) -> pd.DataFrame:
+        return records.groupby(KEYS, dropna = False).sum(numeric_only = True)
+
+    def update(self, data: pd.DataFrame, failed: pd.DataFrame = None):
+        """
+        Adds new respondents and replaces corrected ones. Only the groups of these respondents are recomputed:
+        the old contributions are subtracted from the sums and the new ones added
+        """
+        records = self.derive(data, failed)
+        self.remove(records.index)
+        delta = self.group(records)
+        self.records = pd.concat([self.records, records]) if len(self.records) else records
+        self.sums = delta if self.sums.empty else self.sums.add(delta, fill_value = 0).fillna(0)
+        return self
+
+    def remove(self, ids):
+        """
+        Drops respondents (e.g. entries that were cleared from the sheet) by subtracting their contributions from the sums
+        """
+        if not len(self.records):
+            return self
+        gone = self.records.index.isin(ids)
+        if gone.any():
+            self.sums = self.sums.sub(self.group(self.records.loc[gone]), fill_value = 0).fillna(0)
+            self.sums = self.sums.loc[self.sums['entries'] > 0] # Groups that lost all their respondents
+            self.records = self.records.loc[~gone]
+        return self
+
+    def report(self, by: str = 'Name_interviewer') -> pd.DataFrame:
+        """
+        Statistics per interviewer, Group, Location or Date:
+        entries, entries per day, missing rate per question, conversion failures per column,
+        mean number of answered choice cards, fraction of complete choice sets and the mean interview duration in minutes
+        """
+        if self.sums.empty:
+            return pd.DataFrame()
+        sums = self.sums.groupby(level = by, dropna = False).sum()
+        days = self.sums.index.to_frame(index = False).groupby(by, dropna = False)['Date'].nunique()
+        report = pd.DataFrame({'entries':sums['entries']}, index = sums.index)
+        report['entries_per_day'] = sums['entries'] / days.reindex(sums.index).replace(0, np.nan)
+        missing = [c for c in sums.columns if c.startswith('missing:')]
+        report[missing] = sums[missing].div(sums['entries'], axis = 0)
+        failed = [c for c in sums.columns if c.startswith('failed:')]
+        report[failed] = sums[failed]
+        if 'cards_answered' in sums.columns:
+            report['cards_answered'] = sums['cards_answered'] / sums['entries']
+            report['cards_complete'] = sums['cards_complete'] / sums['entries']
+        if 'duration' in sums.columns:
+            report['duration'] = sums['duration'] / sums['durations'].replace(0, np.nan)
+        return report
+
+    def missing_rate(self) -> pd.Series:
+        """
+        Overall missing rate per question
+        """
+        missing = [c for c in self.sums.columns if c.startswith('missing:')]
+        rate = self.sums[missing].sum() / self.sums['entries'].sum()
+        rate.index = [c.split(':', 1)[1] for c in missing]
+        return rate
+
+    def check(self, survey):
+        """
+        Updates with the rows that the survey (Questionaire or Kobo) parsed last. After an incremental
+        Questionaire.parse_form these are only the new and changed respondents
+        Without a plan (nothing parsed here, or the questions changed since) all of survey.data is checked, without failures
+        Respondents that are no longer in survey.data are removed
+        """
+        if len(self.records):
+            self.remove(self.records.index.difference(survey.data.index))
+        if survey.plan is None:
+            return self.update(survey.data)
+        rows = survey.plan.failed.index
+        return self.update(survey.data.loc[survey.data.index.isin(rows)], survey.plan.failed)
+
+    def to_pickle(self, path: str):
+        pd.to_pickle((self.questions, self.cards, self.records, self.sums), path)
+
+    @classmethod
+    def read_pickle(cls, path: str):
+        qc = cls({})
+        qc.questions, qc.cards, qc.records, qc.sums = pd.read_pickle(path)
+        return qc
@@ -0,0 +1,84 @@
+"""
+Declarative questionaires: the questions and custom fields written down in a json schema file instead of add_question calls
+    {"custom_fields": [{"name": "start", "dtype": "datetime64"}, ...],
+     "questions": [{"text": "Origin", "dtype": "string", "subquestions": [{"text": "Origin specification", "dtype": "string"}]},
+                   {"text": "Version", "dtype": "Int32", "cards": {"text": "Scenario on card {card}", "dtype": "Int32"}}, ...]}
+Ids are stable: an explicit "id", or else the position in the file (1, 2, .. and parent.1, parent.2, .. for subquestions),
+so they do not depend on what else was created in the process. "cards" is expanded into one subquestion per choice card
+The compiled registry and its QuestionIndex are cached in pickle form, keyed on the file and the number of cards
+"""
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from .survey import Question, CustomField, QuestionIndex, Kobo
+from .instrument import profile
+
+DTYPES = {
+    'string':pd.StringDtype(),
+    'boolean':pd.BooleanDtype(),
+    'Int16':pd.Int16Dtype(),
+    'Int32':pd.Int32Dtype(),
+    'Int64':pd.Int64Dtype(),
+    'float64':np.float64,
+    'datetime64':np.datetime64,
+    }
+
+def compile_schema(schema: dict, ncards: int) -> tuple:
+    """
+    The registry (custom fields first, then the questions in file order) and its index
+    """
+    questions = OrderedDict()
+    fields = []
+    for entry in schema.get('custom_fields', []):
+        field = CustomField(entry['name'], DTYPES[entry['dtype']])
+        questions.update({field.name:field})
+        fields.append(field.name)
+
+    def add(entry: dict, id: str, parent: Question = None):
+        question = Question(entry['text'], DTYPES[entry['dtype']], parent_question = parent, id = entry.get('id', id))
+        if question.id in questions:
+            raise ValueError(f'duplicate question id {question.id} in schema')
+        questions.update({question.id:question})
+        subquestions = []
+        if 'cards' in entry:
+            subquestions += [dict(entry['cards'], text = entry['cards']['text'].format(card = card)) for card in range(1, ncards + 1)]
+        subquestions += entry.get('subquestions', [])
+        for i, sub in enumerate(subquestions, start = 1):
+            add(sub, f'{question.id}.{i}', parent = question)
+
+    for i, entry in enumerate(schema.get('questions', []), start = 1):
+        add(entry, str(i))
+    return questions, QuestionIndex(questions), fields
+
+def load_schema(path: str, ncards: int, kind: type = Kobo, cachedir: str = '~/.cache/questions'):
+    """
+    A new Kobo or Questionaire with the questions of the schema file. The Questionaire (google sheets) gets no custom fields
+    The compiled form is cached, keyed on the path, size and modification time of the file and on ncards
+    """
+    path = os.path.abspath(os.path.expanduser(path))
+    stat = os.stat(path)
+    key = hashlib.sha1(f'{path}:{stat.st_size}:{stat.st_mtime_ns}:{ncards}'.encode()).hexdigest()
+    cachedir = os.path.expanduser(cachedir)
+    cached = os.path.join(cachedir, f'schema_{key}.pickle')
+    if os.path.exists(cached):
+        with profile.stage('schema.cached'):
+            with open(cached, 'rb') as f:
+                questions, index, fields = pickle.load(f)
+    else:
+        with profile.stage('schema.compile'):
+            with open(path) as f:
+                questions, index, fields = compile_schema(json.load(f), ncards = ncards)
+        os.makedirs(cachedir, exist_ok = True)
+        with open(cached, 'wb') as f:
+            pickle.dump((questions, index, fields), f, protocol = pickle.HIGHEST_PROTOCOL)
+    survey = kind()
+    if hasattr(survey, 'add_custom_field'):
+        survey.questions = questions
+        survey.index = index
+    else:
+        survey.questions = OrderedDict((key, q) for key, q in questions.items() if key not in fields)
+    return survey
@@ -0,0 +1,537 @@
+"""
+Access layer for the google sheets api. All reads and writes of the questionaire go through here:
+writes are merged into batchUpdate calls, large reads and writes are split into bounded row blocks,
+requests are throttled to stay within the quota and retried with exponential backoff when the quota is exceeded anyway
+SheetsReader reads many spreadsheets (one per fieldwork group) concurrently, straight from the values endpoint
+Also contains an in-process stand-in for the sheets service, so that throughput and failure behaviour can be tested offline,
+and a local http server around it for the concurrent reader
+"""
+import re
+import time
+import json
+import queue
+import random
+import asyncio
+import threading
+import http.client
+import urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .instrument import profile
+
+RETRY_STATUSES = (429, 500, 503) # Quota exceeded and temporary backend trouble
+SHEETS_URL = 'https://sheets.googleapis.com/v4/spreadsheets'
+
+def column_letter(n: int) -> str:
+    """
+    The A1 notation letters of the n-th (1-based) column. So 1 -> A, 26 -> Z, 27 -> AA
+    """
+    letters = ''
+    while n > 0:
+        n, remainder = divmod(n - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+def column_number(letters: str) -> int:
+    """
+    Inverse of column_letter. So A -> 1, Z -> 26, AA -> 27
+    """
+    n = 0
+    for letter in letters.upper():
+        n = n * 26 + ord(letter) - ord('A') + 1
+    return n
+
+def a1_range(tab: str, first_row: int, last_row: int = None, first_col: int = 1, last_col: int = None) -> str:
+    """
+    A1 notation of a block, 1-based and inclusive. Without last_col the block spans all columns,
+    without last_row it is open-ended downwards
+    """
+    if last_col is None:
+        if last_row is None:
+            raise ValueError('a range needs at least a last row or a last column')
+        return f'{tab}!{first_row}:{last_row}'
+    start = f'{column_letter(first_col)}{first_row}'
+    end = column_letter(last_col) if last_row is None else f'{column_letter(last_col)}{last_row}'
+    return f'{tab}!{start}:{end}'
+
+def row_count(properties: dict, tab: str) -> int:
+    """
+    The number of rows in the grid of a tab (trailing empty rows included), from the response to a spreadsheet properties request
+    """
+    for sheet in properties.get('sheets', []):
+        if sheet['properties']['title'] == tab:
+            return int(sheet['properties']['gridProperties']['rowCount'])
+    raise ValueError(f'no tab {tab} in spreadsheet {properties.get("spreadsheetId", "")}'.strip())
+
+def error_status(error: Exception) -> int:
+    """
+    The http status of an api error (googleapiclient.errors.HttpError carries it in resp.status)
+    """
+    try:
+        return int(error.resp.status)
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+class SheetsIO(object):
+    """
+    Batched, chunked and retrying access to one tab of a spreadsheet
+    sheet is the spreadsheets() resource of the api service, or a FakeSheets
+    """
+    def __init__(self, sheet, sheetid: str, tab: str = 'Sheet1', blockrows: int = 1000, per_minute: int = 60, retries: int = 5, backoff: float = 1.0, clock = time.monotonic, sleep = time.sleep):
+        """
+        blockrows bounds the number of rows in a single read or write request
+        per_minute is the request rate that is not exceeded (the default sheets quota is 60 per user per minute)
+        retries is the number of retries on quota errors, waiting backoff * 2**attempt (plus jitter) seconds in between
+        """
+        self.sheet = sheet
+        self.sheetid = sheetid
+        self.tab = tab
+        self.blockrows = blockrows
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self.retries = retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.pending = [] # Queued writes as dicts with range and values
+        self.last_request = None
+        self.nrequests = 0
+        self.nretries = 0
+
+    def __repr__(self):
+        return f'SheetsIO {self.sheetid}!{self.tab}: {self.nrequests} requests, {self.nretries} retries, {len(self.pending)} pending writes'
+
+    def execute(self, request):
+        """
+        Executes an api request, throttled to the request rate and retried on quota errors
+        """
+        for attempt in range(self.retries + 1):
+            if self.last_request is not None:
+                wait = self.last_request + self.interval - self.clock()
+                if wait > 0:
+                    self.sleep(wait)
+            self.last_request = self.clock()
+            self.nrequests += 1
+            profile.count('sheets.requests')
+            try:
+                with profile.stage('sheets.request'):
+                    return request.execute()
+            except Exception as error:
+                if error_status(error) not in RETRY_STATUSES or attempt == self.retries:
+                    raise
+                self.nretries += 1
+                profile.count('sheets.retries')
+                self.sleep(self.backoff * 2**attempt + random.uniform(0, self.backoff))
+
+    def nrows(self) -> int:
+        """
+        The number of rows in the grid of the tab (trailing empty rows included), from the spreadsheet properties
+        """
+        return row_count(self.execute(self.sheet.get(spreadsheetId = self.sheetid, fields = 'sheets.properties')), self.tab)
+
+    def read(self, first_row: int = 1, last_row: int = None, ncols: int = None) -> list:
+        """
+        Reads rows as a list of lists of strings, in blocks of at most blockrows rows
+        Without last_row it reads up to the row count of the tab. The api omits trailing empty rows of a block,
+        so these are filled in as empty rows when more follow. Trailing empty rows of the result are left out
+        Without ncols all columns are read
+        """
+        if last_row is None:
+            last_row = self.nrows()
+        rows = []
+        for start in range(first_row, last_row + 1, self.blockrows):
+            stop = min(start + self.blockrows - 1, last_row)
+            rangename = a1_range(self.tab, start, stop, last_col = ncols) if ncols else a1_range(self.tab, start, stop)
+            block = self.execute(self.sheet.values().get(spreadsheetId = self.sheetid, range = rangename)).get('values', [])
+            rows.extend(block)
+            rows.extend([] for _ in range(stop - start + 1 - len(block)))
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def write(self, values: list, first_row: int = 1, first_col: int = 1):
+        """
+        Queues values (list of rows) to be written with their upper left cell at (first_row, first_col)
+        Large writes are split into blocks of rows. Nothing is sent before flush
+        """
+        for offset in range(0, len(values), self.blockrows):
+            block = [list(row) for row in values[offset:offset + self.blockrows]]
+            width = max((len(row) for row in block), default = 0)
+            if width == 0:
+                continue
+            row = first_row + offset
+            rangename = a1_range(self.tab, row, row + len(block) - 1, first_col, first_col + width - 1)
+            self.pending.append({'range':rangename, 'values':block})
+
+    def flush(self):
+        """
+        Sends the queued writes, merged into as few batchUpdate calls as possible of at most blockrows rows each
+        """
+        batches = []
+        nrows = 0
+        for data in self.pending:
+            if not batches or nrows + len(data['values']) > self.blockrows:
+                batches.append([])
+                nrows = 0
+            batches[-1].append(data)
+            nrows += len(data['values'])
+        for batch in batches:
+            body = {'valueInputOption':'RAW', 'data':batch}
+            self.execute(self.sheet.values().batchUpdate(spreadsheetId = self.sheetid, body = body))
+            self.pending = self.pending[len(batch):]
+
+class SheetsHttpError(Exception):
+    """
+    Error status of a direct request to the values endpoint, found in resp.status like googleapiclient.errors.HttpError
+    """
+    class Response(object):
+        def __init__(self, status):
+            self.status = status
+
+    def __init__(self, status: int, message: str = ''):
+        super().__init__(f'http error {status} {message}'.strip())
+        self.resp = self.Response(status)
+
+class HttpPool(object):
+    """
+    Keep-alive connections to the host of url, shared by the threads of a SheetsReader
+    At most size connections are open and each one serves a single request at a time
+    """
+    def __init__(self, url: str, size: int = 8, timeout: float = 60.0):
+        parts = urllib.parse.urlsplit(url)
+        self.kind = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.nconnections = 0
+
+    def __repr__(self):
+        return f'HttpPool {self.host}: {self.nconnections} connections opened, {self.idle.qsize()} idle'
+
+    def connect(self):
+        with self.lock:
+            self.nconnections += 1
+        return self.kind(self.host, timeout = self.timeout)
+
+    def send(self, connection, path: str, headers: dict) -> tuple:
+        connection.request('GET', self.prefix + path, headers = headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def request(self, path: str, headers: dict) -> tuple:
+        """
+        GET of path (below the url), returns the status and the body
+        An idle connection that was closed by the server in the meantime is replaced once
+        """
+        with self.slots:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                connection = self.connect()
+            try:
+                try:
+                    response, body = self.send(connection, path, headers)
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    connection = self.connect()
+                    response, body = self.send(connection, path, headers)
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.idle.put(connection)
+        return response.status, body
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
+
+class SheetsReader(object):
+    """
+    Concurrent reads of many spreadsheets with asyncio, for the groups that each enter their surveys in their own sheet
+    All requests share one credential and one pool of keep-alive connections, at most limit of them are in flight
+    The blocking http calls run in a thread pool of the same size, so only the standard library is needed
+    token is the oauth access token, or a function that returns a valid one (e.g. refreshing the credential when expired)
+    url is the spreadsheets endpoint of the api, or that of a FakeSheetsServer
+    """
+    def __init__(self, token, url: str = SHEETS_URL, tab: str = 'Sheet1', limit: int = 8, blockrows: int = 1000, retries: int = 5, backoff: float = 1.0):
+        self.token = token
+        self.tab = tab
+        self.limit = limit
+        self.blockrows = blockrows
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = HttpPool(url, size = limit)
+        self.nrequests = 0
+        self.nretries = 0
+
+    def __repr__(self):
+        return f'SheetsReader of {self.pool.host}: {self.nrequests} requests, {self.nretries} retries, {self.pool.nconnections} connections'
+
+    def headers(self) -> dict:
+        token = self.token() if callable(self.token) else self.token
+        return {'Authorization':f'Bearer {token}', 'Accept':'application/json'}
+
+    async def get(self, sheetid: str, rangename: str = None) -> dict:
+        """
+        One values get request, or without rangename a request of the spreadsheet properties
+        Retried with exponential backoff (plus jitter) on quota errors
+        """
+        if rangename is None:
+            path = f'/{urllib.parse.quote(sheetid)}?fields=sheets.properties'
+        else:
+            path = f'/{urllib.parse.quote(sheetid)}/values/{urllib.parse.quote(rangename)}'
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            async with self.semaphore:
+                self.nrequests += 1
+                profile.count('sheets.requests')
+                status, body = await loop.run_in_executor(self.executor, self.pool.request, path, self.headers())
+            if status == 200:
+                return json.loads(body)
+            if status not in RETRY_STATUSES or attempt == self.retries:
+                raise SheetsHttpError(status, f'reading {rangename or "properties"} of {sheetid}')
+            self.nretries += 1
+            profile.count('sheets.retries')
+            await asyncio.sleep(self.backoff * 2**attempt + random.uniform(0, self.backoff))
+
+    async def read(self, sheetid: str) -> list:
+        """
+        All rows of a sheet as a list of lists of strings. The row count of the tab is requested first, then its blocks
+        of blockrows rows are read concurrently. The rows that the api omits at the end of a block are filled in as empty
+        rows when more follow, trailing empty rows of the sheet are left out
+        """
+        nrows = row_count(await self.get(sheetid), self.tab)
+        starts = range(1, nrows + 1, self.blockrows)
+        stops = [min(start + self.blockrows - 1, nrows) for start in starts]
+        blocks = await asyncio.gather(*[self.get(sheetid, a1_range(self.tab, start, stop)) for start, stop in zip(starts, stops)])
+        rows = []
+        for start, stop, block in zip(starts, stops, blocks):
+            values = block.get('values', [])
+            rows.extend(values)
+            rows.extend([] for _ in range(stop - start + 1 - len(values)))
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    async def read_all(self, sheetids: list) -> dict:
+        self.semaphore = asyncio.Semaphore(self.limit)
+        grids = await asyncio.gather(*[self.read(sheetid) for sheetid in sheetids])
+        return dict(zip(sheetids, grids))
+
+    def fetch(self, sheetids: list) -> dict:
+        """
+        Reads the sheets concurrently, returns the rows per sheet id. The connections stay open for a next fetch
+        """
+        with ThreadPoolExecutor(max_workers = self.limit) as self.executor:
+            return asyncio.run(self.read_all(list(sheetids)))
+
+    def close(self):
+        self.pool.close()
+
+class FakeHttpError(Exception):
+    """
+    Mimics googleapiclient.errors.HttpError: the status is found in resp.status
+    """
+    class Response(object):
+        def __init__(self, status):
+            self.status = status
+
+    def __init__(self, status: int):
+        super().__init__(f'fake http error {status}')
+        self.resp = self.Response(status)
+
+class FakeRequest(object):
+    """
+    Delays the work until execute, like the api request objects
+    """
+    def __init__(self, service, method: str, work):
+        self.service = service
+        self.method = method
+        self.work = work
+
+    def execute(self):
+        self.service.calls.append(self.method)
+        if self.service.failures:
+            raise FakeHttpError(self.service.failures.pop(0))
+        return self.work()
+
+class FakeValues(object):
+
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, spreadsheetId: str, range: str):
+        return FakeRequest(self.service, 'get', lambda: self.service.read(spreadsheetId, range))
+
+    def update(self, spreadsheetId: str, range: str, body: dict, valueInputOption: str = 'RAW'):
+        return FakeRequest(self.service, 'update', lambda: self.service.write(spreadsheetId, range, body['values']))
+
+    def batchUpdate(self, spreadsheetId: str, body: dict):
+        def work():
+            for data in body['data']:
+                self.service.write(spreadsheetId, data['range'], data['values'])
+            return {'spreadsheetId':spreadsheetId, 'totalUpdatedRows':sum(len(data['values']) for data in body['data'])}
+        return FakeRequest(self.service, 'batchUpdate', work)
+
+class FakeSheets(object):
+    """
+    In-process stand-in for the spreadsheets() resource of the sheets api
+    Holds a grid of strings per spreadsheet id and answers the values get, update and batchUpdate requests, get (the tab properties) and create
+    Like the api it stores everything as strings and omits trailing empty cells and rows from responses
+    Failures is a list of http statuses that the next executed requests raise (e.g. [429, 429])
+    Calls records the executed api methods, for counting requests
+    """
+    pattern = re.compile(r'^(?P<c1>[A-Z]*)(?P<r1>\d*)(?::(?P<c2>[A-Z]*)(?P<r2>\d*))?$')
+
+    def __init__(self, failures: list = None):
+        self.grids = defaultdict(list)
+        self.failures = list(failures) if failures else []
+        self.calls = []
+
+    def __repr__(self):
+        return f'FakeSheets with {len(self.grids)} sheets after {len(self.calls)} calls'
+
+    def values(self):
+        return FakeValues(self)
+
+    def get(self, spreadsheetId: str, fields: str = None):
+        """
+        The properties of the single tab Sheet1, whose row count is that of the stored grid
+        """
+        def work():
+            properties = {'title':'Sheet1', 'gridProperties':{'rowCount':len(self.grids[spreadsheetId]), 'columnCount':max((len(row) for row in self.grids[spreadsheetId]), default = 0)}}
+            return {'spreadsheetId':spreadsheetId, 'sheets':[{'properties':properties}]}
+        return FakeRequest(self, 'properties', work)
+
+    def create(self, body: dict):
+        def work():
+            sheetid = f'fake{len(self.grids) + 1}'
+            self.grids[sheetid] = []
+            return {'spreadsheetId':sheetid, 'properties':body.get('properties', {})}
+        return FakeRequest(self, 'create', work)
+
+    def parse_range(self, rangename: str) -> tuple:
+        """
+        Returns zero-based (first_row, last_row, first_col, last_col), ends exclusive and None when open
+        """
+        if '!' in rangename:
+            match = self.pattern.match(rangename.split('!', 1)[1])
+            if match is None:
+                raise FakeHttpError(400)
+        else:
+            match = self.pattern.match(rangename)
+            if match is None: # Only the tab name, the full sheet
+                return 0, None, 0, None
+        c1, r1, c2, r2 = match.group('c1', 'r1', 'c2', 'r2')
+        first_row = int(r1) - 1 if r1 else 0
+        first_col = column_number(c1) - 1 if c1 else 0
+        if c2 is None and r2 is None: # A single cell
+            return first_row, first_row + 1, first_col, first_col + 1
+        last_row = int(r2) if r2 else None
+        last_col = column_number(c2) if c2 else None
+        return first_row, last_row, first_col, last_col
+
+    def read(self, sheetid: str, rangename: str) -> dict:
+        grid = self.grids[sheetid]
+        first_row, last_row, first_col, last_col = self.parse_range(rangename)
+        rows = [row[first_col:last_col] for row in grid[first_row:last_row]]
+        rows = [self.trim(row) for row in rows]
+        while rows and not rows[-1]:
+            rows.pop()
+        return {'range':rangename, 'values':rows} if rows else {'range':rangename}
+
+    def write(self, sheetid: str, rangename: str, values: list) -> dict:
+        grid = self.grids[sheetid]
+        first_row, last_row, first_col, last_col = self.parse_range(rangename)
+        for i, row in enumerate(values):
+            if last_row is not None and first_row + i >= last_row:
+                raise FakeHttpError(400) # More rows than the range
+            while len(grid) <= first_row + i:
+                grid.append([])
+            target = grid[first_row + i]
+            if len(target) < first_col + len(row):
+                target.extend([''] * (first_col + len(row) - len(target)))
+            target[first_col:first_col + len(row)] = ['' if value is None else str(value) for value in row]
+        return {'updatedRange':rangename, 'updatedRows':len(values)}
+
+    @staticmethod
+    def trim(row: list) -> list:
+        row = list(row)
+        while row and row[-1] == '':
+            row.pop()
+        return row
+
+class FakeSheetsServer(object):
+    """
+    A FakeSheets behind a local http server (127.0.0.1 on a free port) that answers the values get and properties requests of the api,
+    to run a SheetsReader over real connections. Use it as a context manager and pass url to the reader
+    Requests without the bearer token get 401. Connections counts the accepted connections, to check their reuse
+    """
+    def __init__(self, backend: FakeSheets = None, token: str = 'fake-token'):
+        self.backend = FakeSheets() if backend is None else backend
+        self.token = token
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/v4/spreadsheets'
+
+    def __repr__(self):
+        return f'FakeSheetsServer at {self.url}: {len(self.backend.calls)} calls over {self.connections} connections'
+
+    def handler(self):
+        server = self
+        pattern = re.compile(r'^/v4/spreadsheets/(?P<sheetid>[^/?]+)(?:/values/(?P<range>[^?]+))?')
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Keep-alive
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                match = pattern.match(self.path)
+                if match is None:
+                    return self.reply(404, {'error':'not found'})
+                if self.headers.get('Authorization') != f'Bearer {server.token}':
+                    return self.reply(401, {'error':'unauthenticated'})
+                sheetid, rangename = (urllib.parse.unquote(part) if part else None for part in match.group('sheetid', 'range'))
+                with server.lock: # FakeSheets is not thread safe
+                    try:
+                        if rangename is None:
+                            status, result = 200, server.backend.get(spreadsheetId = sheetid).execute()
+                        else:
+                            status, result = 200, server.backend.values().get(spreadsheetId = sheetid, range = rangename).execute()
+                    except FakeHttpError as error:
+                        status, result = error.resp.status, {'error':str(error)}
+                self.reply(status, result)
+
+            def reply(self, status: int, content: dict):
+                body = json.dumps(content).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread = threading.Thread(target = self.httpd.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,697 @@
+"""
+The questionaire side of the pipeline: questions and custom fields, the parsing plan compiled from them,
+the google sheets front end (Questionaire) and the KoBo front end (Kobo)
+"""
+import pandas as pd
+import numpy as np
+import pickle
+import os
+import glob
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from .sheets import SheetsIO, SheetsReader
+from .backup import BackupStore
+from .instrument import profile
+
+# Question: can we actually use google docs regarding privacy and sharing of data?
+# Build our own web-form?
+
+# Encoding of the data database is one row per respondent and as many columns as there are questions: plus additional information like name, version number, groupnumber, which area, date or even hour
+
+TRUE_ENTRIES = ['y','Y','yes','Yes','T','t','TRUE','True','1',1,1.0]
+FALSE_ENTRIES = ['n','N','no','No','F','f','FALSE','False','0',0,0.0]
+BOOL_TABLE = {**{entry:True for entry in TRUE_ENTRIES}, **{entry:False for entry in FALSE_ENTRIES}}
+LETTER_TABLE = {**{chr(96 + i):i for i in range(1,27)}, **{chr(64 + i):i for i in range(1,27)}} # Conversion of 'a', 'b', 'c' to 1,2,3
+
+def convert_to_bool(entry):
+    return BOOL_TABLE.get(entry, np.nan)
+
+def downcast_integers(series: pd.Series) -> pd.Series:
+    """
+    The series in the smallest nullable integer dtype that holds its values
+    """
+    if not series.notna().any():
+        return series.astype(pd.Int8Dtype())
+    low, high = series.min(), series.max()
+    for dtype in (pd.Int8Dtype(), pd.Int16Dtype(), pd.Int32Dtype(), pd.Int64Dtype()):
+        info = np.iinfo(dtype.numpy_dtype)
+        if info.min <= low and high <= info.max:
+            return series.astype(dtype)
+    return series
+
+def align_dtypes(frames: list) -> list:
+    """
+    Compact parsing gives each batch of rows its own categories and integer widths. Before batches are concatenated
+    or assigned into each other, categorical columns get the union of the categories and nullable integer columns the widest dtype
+    The frames are changed in place and returned
+    """
+    for column in frames[0].columns if frames else []:
+        series = [frame[column] for frame in frames if column in frame.columns]
+        if len(set(s.dtype for s in series)) == 1:
+            continue
+        if any(isinstance(s.dtype, pd.CategoricalDtype) for s in series):
+            values = [s.cat.categories if isinstance(s.dtype, pd.CategoricalDtype) else s.dropna().unique() for s in series]
+            dtype = pd.CategoricalDtype(pd.Index(np.concatenate([np.asarray(v, dtype = object) for v in values]), dtype = object).unique())
+        elif all(isinstance(s.dtype, pd.api.extensions.ExtensionDtype) and pd.api.types.is_integer_dtype(s.dtype) for s in series):
+            dtype = max((s.dtype for s in series), key = lambda dtype: dtype.itemsize)
+        else:
+            continue
+        for frame in frames:
+            if column in frame.columns:
+                frame[column] = frame[column].astype(dtype)
+    return frames
+
+def add_unique_id(original_class):
+    """
+    Decorator that gives an incrementally increasing unique self.id to class c each time it is initiated
+    These id's are string type, to be also used as keys in a dictionary
+    Unless the question is initialized with a parent question then the numbering becomes parentid.childid
+    An explicit id = '...' keyword skips the counter, which is how a schema file gives stable ids (see schema.py)
+    """
+    uid = 1
+    orig_init = original_class.__init__
+    # Make copy of original __init__, so we can call it without recursion
+    def __init__(self, text = None, answerdtype = None, parent_question = None, id: str = None):
+        if parent_question is not None: # Do the bookkeeping
+            parent_question.nsubquestions += 1
+        if id is not None:
+            self.id = str(id)
+        elif parent_question is not None:
+            self.id = parent_question.id + '.' + str(parent_question.nsubquestions)
+        else: # We do not have a parent and we continue with unique ids
+            nonlocal uid
+            self.id = str(uid)
+            uid += 1
+        orig_init(self, text, answerdtype, parent_question) # Call the original __init__
+    original_class.__init__ = __init__ # Set the class' __init__ to the new one
+    return original_class
+
+@add_unique_id
+class Question(object):
+    """
+    Want these to have auto-incrementing question id's and have the possibility to be a subquestion of..
+    """
+    def __init__(self, text: str = None, answerdtype: type = None, parent_question = None):
+        """
+        Requires the question text, the desired datatype of the answers
+        If the question is going to be a subquestion then supply the parent
+        """
+        self.text = text
+        self.dtype = answerdtype
+        self.nodata_options = [9999, 999, -999, -9999, '', 'NA','na', 'none','None']
+        # Some bookkeeping
+        self.nsubquestions = 0 # The current amount of questions that are a subquestion of this question
+    
+    def __repr__(self):
+        return f'Question {self.id}: {self.text}'
+
+
+class CustomField(object):
+    """
+    Just custom fields that are produced in the questionare but that do need auto incrementing ids
+    it only needs a unique name
+    """
+    def __init__(self, name, answerdtype: type = None):
+        self.name = name
+        self.text = name
+        self.dtype = answerdtype
+        self.nodata_options = [9999, 999, -999, -9999, '', 'NA','na', 'none','None']
+
+    def __repr__(self):
+        return f'Field {self.name}'
+
+class ParsingPlan(object):
+    """
+    The Question/CustomField definitions compiled once into a plan for parsing the raw responses
+    Per column it holds the no-data sentinels, the target dtype and the chosen conversion path
+    Applying it runs one vectorized kernel per column, without per-cell python callbacks
+    Conversion failures (values present before, but missing after conversion) are counted per column
+    and kept per cell in self.failed
+    """
+    def __init__(self, questions: OrderedDict, letters: bool = False, compact: bool = False, category_ratio: float = 0.5):
+        """
+        Letters enables the conversion of 'a', 'b', 'c' to 1,2,3 for integer answers (as KoBo exports them)
+        Compact stores text answers as categoricals when they have at most category_ratio distinct values per present value
+        (answer options, not free text), and integer answers in the smallest nullable integer dtype that holds them
+        """
+        self.letters = letters
+        self.compact = compact
+        self.category_ratio = category_ratio
+        self.columns = OrderedDict()
+        for key, q in questions.items():
+            nodata = set(q.nodata_options) | set(str(item) for item in q.nodata_options) # Both the raw and the string form
+            self.columns.update({key:(nodata, q.dtype, self.conversion_path(q.dtype, letters = letters))})
+        self.failed = pd.DataFrame(dtype = bool)
+        self.failures = pd.Series(dtype = 'int64')
+
+    def __repr__(self):
+        return f'{OrderedDict((key, path) for key, (nodata, dtype, path) in self.columns.items())}'
+
+    @staticmethod
+    def conversion_path(dtype, letters: bool = False) -> str:
+        """
+        Decides once on the kernel that converts a column to dtype
+        """
+        name = str(dtype).lower()
+        if dtype is None:
+            return 'keep'
+        elif 'datetime' in name:
+            return 'datetime'
+        elif 'int' in name:
+            return 'letters' if letters else 'integer'
+        elif 'float' in name:
+            return 'float'
+        elif 'bool' in name:
+            return 'bool'
+        else:
+            return 'text'
+
+    def apply(self, frame: pd.DataFrame, columns: list = None) -> pd.DataFrame:
+        """
+        Returns a newly parsed frame. Columns not in the plan are passed on untouched
+        With columns only these columns of frame are parsed and returned (without first copying them out of frame)
+        """
+        selection = frame.columns if columns is None else columns
+        columns = OrderedDict()
+        failed = OrderedDict()
+        for column in selection:
+            series = frame[column]
+            if column in self.columns:
+                nodata, dtype, path = self.columns[column]
+                with profile.stage('parse.na'):
+                    series = series.mask(series.isin(nodata)) # Replace the common missing data formats with np.nan
+                    present = series.notna()
+                with profile.stage(f'parse.convert.{column}'):
+                    series = getattr(self, f'_to_{path}')(series, dtype)
+                    if self.compact and path in ('integer', 'letters'):
+                        series = downcast_integers(series)
+                failed.update({column:(present & series.isna()).to_numpy()})
+                profile.count('parse.cells', len(series))
+                profile.count('parse.present', present.sum())
+                profile.count('parse.failed', failed[column].sum())
+            columns.update({column:series})
+        profile.count('parse.rows', len(frame))
+        self.failed = pd.DataFrame(failed, index = frame.index, dtype = bool) # Per cell, for quality control
+        self.failures = self.failed.sum().astype('int64')
+        return pd.DataFrame(columns, index = frame.index)
+
+    @staticmethod
+    def _strip(series: pd.Series) -> pd.Series:
+        """
+        Removes potential newline characters, only present in object columns
+        """
+        if series.dtype == object:
+            return series.replace(to_replace = '\n', value = '', regex = True)
+        return series
+
+    def _to_keep(self, series, dtype):
+        return series
+
+    def _to_text(self, series, dtype):
+        if self.compact:
+            # Factorized once, the newlines are then only removed from the distinct values
+            codes, uniques = pd.factorize(series)
+            if 0 < len(uniques) <= self.category_ratio * (codes >= 0).sum():
+                merged, categories = pd.factorize(pd.Index([str(value).replace('\n', '') for value in uniques], dtype = object))
+                codes = np.where(codes >= 0, merged[np.maximum(codes, 0)], -1)
+                return pd.Series(pd.Categorical.from_codes(codes, categories = categories), index = series.index, name = series.name)
+        # Data is then in string format so the newline removal is a vectorized string method
+        return series.astype(dtype).str.replace('\n', '', regex = False)
+
+    def _to_integer(self, series, dtype):
+        return pd.to_numeric(series, errors = 'coerce').round().astype(dtype)
+
+    def _to_letters(self, series, dtype):
+        numeric = pd.to_numeric(series, errors = 'coerce')
+        numeric = numeric.fillna(self._strip(series).map(LETTER_TABLE).astype('float64'))
+        return numeric.round().astype(dtype)
+
+    def _to_float(self, series, dtype):
+        return pd.to_numeric(series, errors = 'coerce').astype(dtype)
+
+    def _to_bool(self, series, dtype):
+        return self._strip(series).map(BOOL_TABLE).astype(dtype)
+
+    def _to_datetime(self, series, dtype):
+        return pd.to_datetime(self._strip(series), errors = 'coerce')
+
+class QuestionIndex(object):
+    """
+    The question registry compiled once into lookup tables: by id, by (lowercase) text and by parent id,
+    plus the version question and its choice-card subquestions, so that none of these lookups scans the registry
+    """
+    def __init__(self, questions: OrderedDict):
+        self.by_id = questions
+        self.by_text = {}
+        self.parents = {}
+        self.children = {}
+        for key, q in questions.items():
+            self.by_text.setdefault(str(q.text).lower(), key) # The first of duplicate texts wins
+            if isinstance(q, Question) and '.' in key:
+                parent = key.rsplit('.', 1)[0]
+                self.parents[key] = parent
+                self.children.setdefault(parent, []).append(key)
+        self.version = self.by_text.get('version')
+        if self.version is None: # Texts like 'Version number', only once at compile time
+            self.version = next((key for text, key in self.by_text.items() if text.startswith('version')), None)
+        self.cards = list(self.children.get(self.version, []))
+
+    def __repr__(self):
+        return f'QuestionIndex of {len(self.by_id)} questions, version {self.version} with {len(self.cards)} cards'
+
+    def __getitem__(self, key: str):
+        return self.by_id[key]
+
+    def lookup(self, text: str):
+        """
+        The question with this text (case insensitive)
+        """
+        return self.by_id[self.by_text[text.lower()]]
+
+    def subquestions(self, key: str) -> list:
+        return [self.by_id[child] for child in self.children.get(key, [])]
+
+class Questionaire(object):
+
+    def __init__(self, compact: bool = False):
+        """
+        Compact parses into categoricals and downcast integers (see ParsingPlan)
+        """
+        self.questions = OrderedDict()
+        self.compact = compact
+        self.sheetscope = ['https://www.googleapis.com/auth/spreadsheets'] # projecname: choice-experiment
+        self.backupdir = os.path.expanduser('~/ownCloud/Tenerife/backups/')
+        self.backups = BackupStore(self.backupdir)
+        self.plan = None # Compiled on first parse, reset when questions are added
+        self.index = None # Compiled on first lookup, idem
+        self.header = None # Zeroth row of the sheet with the question ids
+        self.synced_rows = None # Sheet row number (1-based) of the last filled row at the previous sync
+        self.creds = None # Google credential, shared by all sheet access
+
+    def __repr__(self):
+        return f'{self.questions}'
+
+    def add_question(self, question: Question):
+        self.questions.update({question.id:question})
+        self.plan = None
+        self.index = None
+
+    def compile_plan(self) -> ParsingPlan:
+        if self.plan is None or self.plan.compact != self.compact:
+            self.plan = ParsingPlan(self.questions, compact = self.compact)
+        return self.plan
+
+    def compile_index(self) -> QuestionIndex:
+        if self.index is None:
+            self.index = QuestionIndex(self.questions)
+        return self.index
+
+    def generate_form_headers(self, n_respondents):
+        """ 
+        Generates the index column and the column row that defines
+        the sheet where the survey responses will be entered
+        One row per respondent. The generated index column therefore contains unique respondent-id's
+        The generated column rows contain the question ids and question texts
+        The required data model: row of values tuple(), column of values list(tuple)
+        """
+        self.indexcol = ['id', ''] + list(range(1, n_respondents + 1))
+        self.indexcol = [(s,) for s in self.indexcol]
+        self.columnsrows = [tuple(self.questions.keys()), tuple(q.text for uid,q in self.questions.items())]
+        #self.form = pd.DataFrame(data = None, columns = self.questions.keys(), index = ['text'] + pd.RangeIndex(1, n_respondents + 1).to_list())
+        #self.form.loc['text',:] = [q.text for uid,q in self.questions.items()]
+
+    def credentials(self):
+        """
+        The google credential, loaded once from token.pickle (or obtained through the browser) and refreshed when expired
+        It is kept, so that all sheets and requests of a session share it
+        """
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+        if self.creds is None and os.path.exists('token.pickle'):
+            with open('token.pickle', 'rb') as token:
+                self.creds = pickle.load(token)
+        if not self.creds or not self.creds.valid:
+            if self.creds and self.creds.expired and self.creds.refresh_token:
+                self.creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', self.sheetscope)
+                self.creds = flow.run_local_server(port = 0)
+            with open('token.pickle', 'wb') as token:
+                pickle.dump(self.creds, token)
+        return self.creds
+
+    def establish_sheet_access(self):    
+        """
+        Authenticates with the google api and connects to the sheet. The google client libraries
+        are only imported here, so they are not needed for KoBo-only runs
+        """
+        with profile.stage('sheet_access'):
+            from googleapiclient.discovery import build
+            creds = self.credentials()
+
+            service = build('sheets', 'v4', credentials = creds)
+            sheet = service.spreadsheets()
+        
+            # Create the sheet if it is not present (no pickled id is found) Otherwise import the sheetid
+            if os.path.exists('sheetid.pickle'):
+                with open('sheetid.pickle', 'rb') as sheetid:
+                    sheetid = pickle.load(sheetid)
+            else:
+                data = {'properties':{'title':'choice_experiment_tenerife'}}
+                res = sheet.create(body = data).execute()
+                profile.say('created a new sheet')
+                sheetid = res['spreadsheetId']
+                with open('sheetid.pickle', 'wb') as picklefile:
+                    pickle.dump(sheetid, picklefile)
+            self.connect(sheet, sheetid)
+
+    def connect(self, sheet, sheetid: str, **kwargs):
+        """
+        Sets the spreadsheets resource and the id of the sheet to work with
+        All sheet access goes through the batched and retrying io layer, kwargs are passed on to it
+        Sheet can also be a sheets.FakeSheets for offline use
+        """
+        self.sheet = sheet
+        self.sheetid = sheetid
+        self.io = SheetsIO(sheet, sheetid, **kwargs)
+
+    def upload_form(self):
+        """
+        Places the form in the google drive sheet
+        The index column and the column rows are sent together in one batch
+        """
+        self.io.write(self.indexcol, first_row = 1, first_col = 1)
+        self.io.write(self.columnsrows, first_row = 1, first_col = 2)
+        self.io.flush()
+
+    def download_form(self, first_row: int = 1):
+        """
+        Reads the full form from the cloud, the sheets api delivers 
+        them as strings. list of lists 
+        Rows are read in bounded blocks. With a later first_row only the rows from that (1-based) 
+        sheet row onwards are read, over the width of the known header
+        """
+        ncols = None if self.header is None or first_row == 1 else len(self.header)
+        with profile.stage('download'):
+            strings = self.io.read(first_row = first_row, ncols = ncols)
+        profile.count('download.rows', len(strings))
+        return strings
+
+    def backup_form(self) -> str:
+        """
+        Backs up the array of raw strings to the columnar backup store
+        in my cloud. Only the rows that changed since the previous backup are stored
+        Returns the name of the snapshot
+        """
+        strings = self.download_form()
+        return self.backups.save(strings)
+
+    def restore_form(self, backupname: str):
+        """
+        Restores a backup fully to the sheet overwriting everything that is there
+        Older pickled .backup files can still be restored
+        """
+        if backupname.endswith('.backup'):
+            with open(self.backupdir + backupname, 'rb') as backup:
+                stringlist = pickle.load(backup)
+        else:
+            stringlist = self.backups.rows(backupname)
+
+        print(f'{backupname} holds {len(stringlist)} rows')
+        are_you_sure = input('are you sure you want to restore (y/n):')
+        if are_you_sure == 'y':
+            self.io.write(stringlist)
+            self.io.flush()
+        else:
+            print('did nothing')
+
+    def parse_rows(self, rows: list) -> pd.DataFrame:
+        """
+        Parses rows of raw strings (sheet rows below the two header rows) with the compiled plan
+        If a row has only length 1 then it contains only the generated index. No entries have been filled, and it is skipped
+        The sheets api truncates trailing empty cells, so shorter rows are padded with missing values
+        """
+        width = len(self.header)
+        rows = [row[:width] for row in rows if len(row) > 1]
+        frame = pd.DataFrame(rows, columns = self.header, dtype = object)
+        frame.index = pd.Index(frame.pop(self.header[0]).astype('int'), name = self.header[0]) # Cast the index to integer
+        # Replace the common missing data formats, remove newlines and cast the columns to the desired dtypes
+        # Values that do not survive the conversion are counted per column
+        frame = self.compile_plan().apply(frame)
+        self.failures = self.plan.failures
+        if self.failures.any():
+            profile.say(f'conversion failures: {self.failures[self.failures > 0].to_dict()}')
+        return frame
+
+    def sync_sheets(self, sheetids: list, limit: int = 8, reader = None, **kwargs) -> pd.DataFrame:
+        """
+        Multi-sheet mode, for when every group enters its surveys in its own sheet with the generated headers
+        The sheets are downloaded concurrently (see sheets.SheetsReader) with one credential and one connection pool,
+        at most limit requests in flight, and kwargs are passed on to the reader. reader can be given to reuse its
+        connections over syncs, or to point at a sheets.FakeSheetsServer. Each sheet is parsed with its own header row
+        and everything is merged into self.data, with the source sheet in column 'sheet'.
+        The sheet row ids are kept in column 'row'; the index is renumbered when they collide between sheets
+        The conversion failures of all sheets are kept in self.plan.failed, aligned with self.data
+        Returns the number of rows and respondents per sheet (also stored in self.report)
+        """
+        if reader is None:
+            reader = SheetsReader(lambda: self.credentials().token, limit = limit, **kwargs)
+        with profile.stage('download'):
+            grids = reader.fetch(sheetids)
+        frames, masks, counts = [], [], []
+        for sheetid in sheetids:
+            strings = grids[sheetid]
+            profile.count('download.rows', len(strings))
+            counts.append((max(len(strings) - 2, 0), 0))
+            if not strings:
+                profile.say(f'sheet {sheetid} is empty')
+                continue
+            self.header = strings[0]
+            frame = self.parse_rows(strings[2:])
+            frame.insert(0, 'row', frame.index.to_numpy())
+            frame.insert(0, 'sheet', pd.Categorical([sheetid] * len(frame), categories = list(sheetids)))
+            frames.append(frame)
+            masks.append(self.plan.failed)
+            counts[-1] = (counts[-1][0], len(frame))
+        self.data = pd.concat(align_dtypes(frames)) if frames else pd.DataFrame()
+        if not self.data.index.is_unique:
+            profile.say('respondent ids collide between sheets, renumbering')
+            self.data.index = pd.RangeIndex(1, len(self.data) + 1, name = self.data.index.name)
+        # The conversion failures per cell, like self.data one after the other and renumbered, for quality control
+        failed = pd.concat(masks).fillna(False).astype(bool) if masks else pd.DataFrame(dtype = bool)
+        failed.index = self.data.index
+        self.compile_plan().failed = failed
+        self.plan.failures = failed.sum().astype('int64')
+        self.failures = self.plan.failures
+        self.synced_rows = None # The incremental parse_form tracks a single sheet
+        self.report = pd.DataFrame(counts, columns = ['rows','respondents'], index = pd.Index(list(sheetids), name = 'sheet'))
+        profile.say(self.report.to_string())
+        return self.report
+
+    def parse_form(self, full: bool = False, recheck: int = 5):
+        """
+        Parsing the form, first with general information on position:
+        zeroth column is the index with unique rows
+        zeroth row contains the question ids (starting 
+        first row can be skipped because it contains the question texts (see generate_form_headers)
+        Then, based on the question ids we start parsing the dtypes
+        After a first full sync the parsing is incremental: only the rows from the last filled row of
+        the previous sync onwards are downloaded and parsed, and patched into self.data.
+        Recheck is the number of previously synced rows that is re-read to pick up recent corrections.
+        Use full = True to download and parse everything again (e.g. after older rows were corrected)
+        self.failures then counts the conversion failures in the rows that were just parsed
+        """
+        if full or self.synced_rows is None or self.plan is None: # No plan means that the questions have changed
+            strings = self.download_form() # major dimension = rows
+            self.header = strings[0]
+            filled = [i + 1 for i, row in enumerate(strings[2:], start = 2) if len(row) > 1]
+            self.synced_rows = max(filled, default = 2)
+            self.data = self.parse_rows(strings[2:])
+        else:
+            first_row = max(self.synced_rows - recheck, 2) + 1
+            strings = self.download_form(first_row = first_row)
+            filled = [i for i, row in enumerate(strings, start = first_row) if len(row) > 1]
+            cleared = [int(row[0]) for row in strings if len(row) == 1 and row[0] != ''] # Entries that were removed
+            self.synced_rows = max(filled, default = first_row - 1)
+            new = self.parse_rows(strings)
+            align_dtypes([self.data, new])
+            # Changed rows are overwritten in place, the rest is appended
+            present = new.index.isin(self.data.index)
+            positions = self.data.index.get_indexer(new.index[present])
+            for column in new.columns: # Array-wise, aligning a frame of nullable columns with loc fails in pandas 3
+                self.data.iloc[positions, self.data.columns.get_loc(column)] = new[column].array[present]
+            self.data.drop([i for i in cleared if i in self.data.index], inplace = True)
+            if not present.all():
+                self.data = pd.concat([self.data, new.loc[~present]])
+        
+class Kobo(object):
+
+    def __init__(self, compact: bool = False):
+        """
+        Compact parses into categoricals and downcast integers (see ParsingPlan) and releases the raw responses
+        """
+        self.questions = OrderedDict()
+        self.compact = compact
+        self.backupdir = os.path.expanduser('~/ownCloud/Tenerife/backups/')
+        self.plan = None # Compiled on first parse, reset when questions are added
+        self.index = None # Compiled on first lookup, idem
+
+    def __repr__(self):
+        return f'{self.questions}'
+
+    def add_question(self, question: Question):
+        self.questions.update({question.id:question})
+        self.plan = None
+        self.index = None
+
+    def add_custom_field(self, field: CustomField):
+        self.questions.update({field.name:field})
+        self.plan = None
+        self.index = None
+
+    def compile_plan(self) -> ParsingPlan:
+        if self.plan is None or self.plan.compact != self.compact:
+            self.plan = ParsingPlan(self.questions, letters = True, compact = self.compact)
+        return self.plan
+
+    def compile_index(self) -> QuestionIndex:
+        if self.index is None:
+            self.index = QuestionIndex(self.questions)
+        return self.index
+
+    @staticmethod
+    def renamer(colname) -> str:
+        """
+        Replaces the present questions with id's by their id. Format with qid: _1_location or just text 
+        """
+        colname = str(colname)
+        parts = np.array(colname[:8].split('_'))
+        parts = parts[[s.isdigit() for s in parts]].tolist()
+        if parts:
+            return '.'.join(parts)
+        else:
+            return colname
+
+    def iter_form(self, path, chunksize: int = 5000, project: bool = True, keep: list = ()):
+        """
+        Streams the form stored on disk as xlsx in frames of at most chunksize rows
+        The header is resolved up front to question ids (see renamer). With project only the _index column, the columns
+        of registered questions and custom fields and those named in keep (e.g. _uuid) are materialized, the rest of the KoBo metadata is never held in memory
+        """
+        import openpyxl
+        workbook = openpyxl.load_workbook(os.path.expanduser(path), read_only = True, data_only = True)
+        try:
+            rows = workbook.worksheets[0].iter_rows(values_only = True)
+            header = [self.renamer(name) if name is not None else None for name in next(rows)]
+            positions = [i for i, name in enumerate(header) if name is not None and (not project or name == '_index' or name in self.questions or name in keep)]
+            columns = [header[i] for i in positions]
+            chunk = []
+            nchunks = 0
+            for row in rows:
+                values = [row[i] if i < len(row) else None for i in positions]
+                if all(value is None for value in values): # Blank lines are skipped
+                    continue
+                chunk.append(values)
+                if len(chunk) == chunksize:
+                    yield pd.DataFrame(chunk, columns = columns, dtype = object)
+                    chunk = []
+                    nchunks += 1
+            if chunk or nchunks == 0: # Always at least one (possibly empty) frame
+                yield pd.DataFrame(chunk, columns = columns, dtype = object)
+        finally:
+            workbook.close()
+
+    def read_form(self, path, chunksize: int = 5000, project: bool = True, keep: list = ()):
+        """
+        Reads the full form stored on disk as xlsx, streaming through it in chunks of rows
+        With project only the columns that are in the questionaire (or in keep) are kept (see iter_form)
+        """
+        with profile.stage('read_form'):
+            chunks = list(self.iter_form(path, chunksize = chunksize, project = project, keep = keep))
+            self.response = pd.concat(chunks, ignore_index = True) if len(chunks) > 1 else chunks[0]
+        profile.count('read_form.rows', len(self.response))
+        profile.count('read_form.cells', self.response.size)
+
+    def parse_form(self):
+        """
+        Parsing the form, headers are in zeroth row. Format with qid: _1_location or just text 
+        The index of the respondent id's is _index
+        Then, based on the question ids we start parsing the dtypes
+        """
+        self.response.set_index('_index', inplace = True)
+        self.response.index.name = 'id'
+        self.response.index = self.response.index.astype('int')# Cast the index to integer
+        self.response.rename(columns = self.renamer, inplace = True) # A no-op when read_form already resolved the header
+        # Remove columns not in the questionaire, then replace the common missing data formats, 
+        # remove newlines and cast the columns to the desired dtypes. Values that do not survive the conversion are counted per column
+        parsed = [c for c in self.response.columns if c in self.questions]
+        self.data = self.compile_plan().apply(self.response, columns = parsed)
+        if self.compact: # Only the unparsed columns (e.g. _uuid) of the raw responses are held on to
+            self.response = self.response.drop(columns = parsed)
+        self.failures = self.plan.failures
+        if self.failures.any():
+            profile.say(f'conversion failures: {self.failures[self.failures > 0].to_dict()}')
+
+    def ingest(self, paths, processes: int = None, key: str = '_uuid') -> pd.DataFrame:
+        """
+        Reads and parses many exports (daily exports, backups, several groups) in a process pool
+        paths is a directory (all .xlsx in it), a glob pattern or a list of files
+        Respondents are deduplicated on the submission id in column key, falling back to _index where that is absent.
+        Of duplicates the copy from the most recently modified file is kept. Everything is concatenated into self.data,
+        which is renumbered when the original ids (of different groups) collide. The source file, the original _index
+        and the submission id are kept in columns 'file', '_index' and key
+        The conversion failures of the workers are combined likewise into self.plan.failed, for quality control
+        Returns (and stores in self.report) the rows, kept rows and seconds per file
+        """
+        if isinstance(paths, str):
+            pattern = os.path.expanduser(paths)
+            paths = glob.glob(os.path.join(pattern, '*.xlsx') if os.path.isdir(pattern) else pattern)
+        paths = sorted(paths, key = os.path.getmtime) # Oldest first, so later copies win
+        template = Kobo(compact = self.compact) # Only the registry is shipped to the workers
+        template.questions = self.questions
+        keep = [key]
+        if processes == 1:
+            results = [read_and_parse(template, path, keep) for path in paths]
+        else:
+            with ProcessPoolExecutor(max_workers = processes) as executor:
+                results = list(executor.map(read_and_parse, [template] * len(paths), paths, [keep] * len(paths)))
+        frames, keys, masks = [], [], []
+        for path, (data, extra, failed, seconds) in zip(paths, results):
+            fallback = ('_index:' + data.index.astype(str)).to_numpy()
+            keys.append(extra[key].astype(object).where(extra[key].notna(), fallback))
+            # Traceable after renumbering: the source file, the original _index and the submission id
+            data.insert(0, key, pd.array(extra[key].astype(object).where(extra[key].notna(), None).to_numpy(), dtype = pd.StringDtype()))
+            data.insert(0, '_index', data.index.to_numpy())
+            data.insert(0, 'file', pd.Categorical([path] * len(data), categories = paths))
+            frames.append(data)
+            masks.append(failed)
+        self.data = pd.concat(align_dtypes(frames)) if frames else pd.DataFrame()
+        duplicated = pd.concat(keys).duplicated(keep = 'last').to_numpy() if keys else np.zeros(0, dtype = bool)
+        self.data = self.data.loc[~duplicated]
+        if not self.data.index.is_unique:
+            profile.say('respondent ids collide between files, renumbering')
+            self.data.index = pd.RangeIndex(1, len(self.data) + 1, name = 'id')
+        failed = pd.concat(masks).fillna(False).astype(bool) if masks else pd.DataFrame(dtype = bool)
+        failed = failed.loc[~duplicated]
+        failed.index = self.data.index
+        self.compile_plan().failed = failed
+        self.plan.failures = failed.sum().astype('int64')
+        self.failures = self.plan.failures
+        bounds = np.cumsum([0] + [len(frame) for frame in frames])
+        self.report = pd.DataFrame({'rows':[len(frame) for frame in frames], 
+            'kept':[int((~duplicated[a:b]).sum()) for a, b in zip(bounds[:-1], bounds[1:])], 
+            'seconds':[result[3] for result in results]}, index = pd.Index(paths, name = 'path'))
+        profile.say(self.report.to_string())
+        return self.report
+
+def read_and_parse(survey: Kobo, path: str, keep: list) -> tuple:
+    """
+    Worker of Kobo.ingest, reads and parses one export with the question registry of survey
+    Returns the parsed data, the kept (unparsed) columns and the conversion failures aligned with it, and the time it took
+    """
+    start = time.perf_counter()
+    survey.read_form(path, keep = keep)
+    survey.parse_form()
+    extra = survey.response.reindex(columns = keep)
+    return survey.data, extra, survey.plan.failed, time.perf_counter() - start
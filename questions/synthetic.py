@@ -0,0 +1,172 @@
+"""
+Synthetic surveys of configurable size, so that the pipeline can be exercised and benchmarked
+without the fieldwork files. Generates a design indexed by (version, card, scenario), the matching
+responses as a KoBo export (DataFrame or xlsx) and as the string grid of the google sheet
+"""
+import numpy as np
+import pandas as pd
+from .survey import Question, CustomField, Questionaire, Kobo
+
+CUSTOM_FIELDS = [('start', np.datetime64), ('end', np.datetime64), ('Name_interviewer', pd.StringDtype()), ('Group', pd.Int16Dtype()), ('Location', pd.StringDtype()), ('Date', np.datetime64)]
+
+# (text, dtype, text of the parent question). The version question and its cards are added after 'Abandonment'
+QUESTIONS = [
+    ('Gender', pd.StringDtype(), None),
+    ('Origin', pd.StringDtype(), None),
+    ('Origin specification', pd.StringDtype(), 'Origin'),
+    ('Number of visits', pd.Int32Dtype(), None),
+    ('Number of days', pd.Int32Dtype(), None),
+    ('Village of stay', pd.StringDtype(), None),
+    ('Transport type', pd.StringDtype(), None),
+    ('Transport usage', np.float64, None),
+    ('Abandonment', pd.StringDtype(), None),
+    ('Statements', pd.BooleanDtype(), None),
+    ('Vineyard visit', pd.BooleanDtype(), 'Statements'),
+    ('Care environment', pd.BooleanDtype(), 'Statements'),
+    ('Age', pd.StringDtype(), None),
+    ('Education', pd.StringDtype(), None),
+    ('Income', pd.StringDtype(), None),
+    ]
+
+ANSWERS = {
+    'Gender':['male', 'female', 'other'],
+    'Origin':['Spain', 'Germany', 'United Kingdom', 'Netherlands', 'France', 'Italy'],
+    'Village of stay':['Puerto de la Cruz', 'Los Cristianos', 'La Laguna', 'Adeje', 'Santa Cruz'],
+    'Transport type':['car', 'bus', 'bike', 'foot'],
+    'Abandonment':['agree', 'neutral', 'disagree'],
+    'Age':['18-25', '26-35', '36-50', '51-65', '65+'],
+    'Education':['primary', 'secondary', 'bachelor', 'master', 'phd'],
+    'Income':['low', 'middle', 'high'],
+    'Name_interviewer':['Ana', 'Bram', 'Carla', 'Daan', 'Eva', 'Fleur'],
+    'Location':['Teide', 'Anaga', 'Masca', 'Teno'],
+    }
+
+NODATA = ['', 'NA', 'none', 9999, None] # A selection of the nodata_options of the questions
+
+METADATA = ['_id', '_uuid', '_submission_time', '_validation_status', '_status', '_submitted_by', '__version__', '_tags', '_notes', 'meta/instanceID', 'deviceid', 'simserial', 'phonenumber', 'subscriberid']
+
+def build_survey(kind: type = Kobo, ncards: int = 6):
+    """
+    Registers the synthetic questions on a new Kobo or Questionaire, with a version question
+    that has one subquestion per choice card (like the fieldwork questionaire)
+    Ids depend on how many questions were created before, so always generate data from the returned survey
+    """
+    survey = kind()
+    if hasattr(survey, 'add_custom_field'):
+        for name, dtype in CUSTOM_FIELDS:
+            survey.add_custom_field(CustomField(name, dtype))
+    bytext = {}
+    for text, dtype, parent in QUESTIONS:
+        question = Question(text, dtype, parent_question = bytext[parent]) if parent else Question(text, dtype)
+        survey.add_question(question)
+        bytext[text] = question
+        if text == 'Abandonment':
+            version = Question('Version', pd.Int32Dtype())
+            survey.add_question(version)
+            for card in range(1, ncards + 1):
+                survey.add_question(Question(f'Scenario on card {card}', pd.Int32Dtype(), parent_question = version))
+    return survey
+
+def make_design(nversions: int = 4, ncards: int = 6, nscenarios: int = 3, nattributes: int = 5, seed: int = 0) -> pd.DataFrame:
+    """
+    Design with integer attribute levels, indexed by (version, card, scenario)
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product([range(1, nversions + 1), range(1, ncards + 1), range(1, nscenarios + 1)], names = ['version','card','scenario'])
+    return pd.DataFrame(rng.integers(0, 4, size = (len(index), nattributes)), index = index, columns = [f'attr{i}' for i in range(1, nattributes + 1)])
+
+def make_responses(survey, design: pd.DataFrame, nrespondents: int = 1000, missing: float = 0.05, seed: int = 0) -> pd.DataFrame:
+    """
+    Raw responses as they come out of a KoBo export: one row per respondent, columns are the registered
+    question ids and custom field names, values are python objects. The _index column holds the respondent ids
+    A fraction missing of the cells holds one of the no-data sentinels. The seed is kept in attrs, for to_kobo
+    """
+    rng = np.random.default_rng(seed)
+    nversions = len(np.unique(design.index.get_level_values('version')))
+    nscenarios = len(np.unique(design.index.get_level_values('scenario')))
+    index = survey.compile_index()
+    version_id, cards = index.version, set(index.cards)
+    days = pd.Timestamp('2020-03-09') + pd.to_timedelta(rng.integers(0, 14, nrespondents), unit = 'D')
+    start = days + pd.to_timedelta(rng.integers(9 * 3600, 18 * 3600, nrespondents), unit = 's')
+    columns = {}
+    for key, q in survey.questions.items():
+        name = str(q.dtype).lower()
+        if key == version_id:
+            values = rng.integers(1, nversions + 1, nrespondents)
+        elif key in cards:
+            values = rng.integers(1, nscenarios + 2, nrespondents) # nscenarios + 1 is the no-pick
+        elif key == 'start':
+            values = start
+        elif key == 'end':
+            values = start + pd.to_timedelta(rng.integers(5 * 60, 40 * 60, nrespondents), unit = 's')
+        elif key == 'Date':
+            values = days
+        elif key == 'Group':
+            values = rng.integers(1, 6, nrespondents)
+        elif q.text in ANSWERS:
+            values = rng.choice(ANSWERS[q.text], nrespondents)
+        elif 'datetime' in name:
+            values = start
+        elif 'int' in name:
+            values = rng.integers(0, 15, nrespondents)
+        elif 'float' in name:
+            values = rng.random(nrespondents).round(2) * 10
+        elif 'bool' in name:
+            values = rng.choice(['yes', 'no'], nrespondents)
+        else:
+            values = rng.choice(['lorem ipsum', 'dolor sit', 'amet\nconsectetur', 'adipiscing'], nrespondents)
+        columns[key] = pd.Series(values).astype(object).tolist()
+    frame = pd.DataFrame(columns, dtype = object)
+    if missing > 0:
+        holes = rng.random(frame.shape) < missing
+        sentinels = rng.integers(0, len(NODATA), frame.shape)
+        for j, column in enumerate(frame.columns):
+            rows = np.nonzero(holes[:,j])[0]
+            frame.iloc[rows, j] = pd.Series([NODATA[k] for k in sentinels[rows, j]], dtype = object).values
+    frame['_index'] = np.arange(1, nrespondents + 1)
+    frame.attrs['seed'] = seed
+    return frame
+
+def kobo_header(key: str, q) -> str:
+    """
+    KoBo column name of a registered question or custom field: _1_location style for questions
+    """
+    if isinstance(q, CustomField):
+        return key
+    return '_' + key.replace('.', '_') + '_' + q.text.lower().replace(' ', '_')
+
+def to_kobo(responses: pd.DataFrame, survey, nmetadata: int = len(METADATA), seed: int = None) -> pd.DataFrame:
+    """
+    The responses with KoBo headers and nmetadata KoBo metadata columns that the pipeline throws away
+    The metadata (the _uuid submission id among it) is a hash of the seed, the column name and the _index, so a respondent
+    keeps its values in every export, whatever else it holds, and responses of another seed get other ones.
+    Without seed that of make_responses is used
+    """
+    seed = responses.attrs.get('seed', 0) if seed is None else seed
+    respondents = responses['_index'].to_numpy(dtype = np.int64).astype(np.uint64)
+    export = responses.rename(columns = {key:kobo_header(key, q) for key, q in survey.questions.items()})
+    for name in METADATA[:nmetadata]:
+        key = pd.util.hash_array(np.array([f'{seed}:{name}'], dtype = object))[0]
+        values = pd.util.hash_array(respondents + key) & np.uint64(2**32 - 1) # Wraps around, and mixes like a random draw
+        export.insert(export.shape[1] - 1, name, [f'{name}-{i:x}' for i in values.tolist()])
+    return export
+
+def write_kobo_xlsx(responses: pd.DataFrame, survey, path: str, nmetadata: int = len(METADATA), seed: int = None):
+    to_kobo(responses, survey, nmetadata = nmetadata, seed = seed).to_excel(path, index = False)
+
+def to_sheet_grid(responses: pd.DataFrame, survey, nempty: int = 0) -> list:
+    """
+    The responses as the sheets api delivers them: list of lists of strings, with the question ids in the zeroth
+    row, the question texts in the first and the respondent id in the zeroth column (see Questionaire.generate_form_headers)
+    Trailing empty cells are cut off. nempty index-only rows are appended, as pre-generated but unfilled respondents
+    """
+    keys = [key for key in survey.questions if key in responses.columns]
+    grid = [['id'] + keys, [''] + [survey.questions[key].text for key in keys]]
+    for respid, row in zip(responses['_index'].tolist(), responses[keys].itertuples(index = False)):
+        strings = [str(respid)] + ['' if value is None or (isinstance(value, float) and np.isnan(value)) else str(value) for value in row]
+        while len(strings) > 1 and strings[-1] == '':
+            strings.pop()
+        grid.append(strings)
+    last = int(responses['_index'].max()) if len(responses) else 0
+    grid.extend([[str(last + i)] for i in range(1, nempty + 1)])
+    return grid